@@ -0,0 +1,378 @@
+#!/usr/local/bin/python3 -u
+# -*- coding: utf-8 -*-
+# We generally follow PEP 8: http://legacy.python.org/dev/peps/pep-0008/
+
+'''
+*Derek C. Braun, Brian H. Greenwald, Samir Jain, Eric Epstein, Brienna Herold, Maggie Gray
+(*derek.braun@gallaudet.edu)
+
+Times the hot paths of the simulation, file I/O and plotting code, and
+saves the results as JSON, so that runs can be compared across commits.
+
+simulation      the parent choosers (customChooser, numpyChooser) for one
+                generation, and whole simulations with each engine, over
+                population sizes and fitness values
+io              Experiment._read, select and select_endpoint on synthetic
+                tsv files with different numbers of replicates
+plotting        violin_plot and contour_plot rendering
+
+Each benchmark is run several times and the fastest and median times are
+saved. With --compare, the fastest times are compared with those of an
+earlier JSON file, and benchmarks that have slowed by more than --threshold
+are flagged, with exit status 1.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import itertools
+import tempfile
+import subprocess
+import multiprocessing
+import numpy
+import fileio
+import grapher
+import simulator
+
+SUITES = ['simulation', 'io', 'plotting']
+
+
+def measure(func, setup=None, repeat=3):
+    '''
+        Times a function.
+
+        Accepts:
+        func            the function to be timed. If setup is given, it is
+                        called with setup's return value.
+        setup           an optional function, called untimed before each run,
+                        e.g. to open a fresh Experiment with empty caches
+        repeat          the number of runs
+
+        Returns a dict with the times of every run, in seconds, and the
+        fastest and median times.
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            func()
+        else:
+            arg = setup()
+            start = time.perf_counter()
+            func(arg)
+        times.append(time.perf_counter() - start)
+    return {'times': times, 'best': min(times), 'median': float(numpy.median(times))}
+
+
+def _experiment(pop_size, fitness, engine, generations=simulator.GENERATIONS):
+    '''
+        Internal function which returns an Experiment with the default
+        parameters of simulator.py.
+    '''
+    return fileio.Experiment(constant_pop_size   = pop_size,
+                             a                   = simulator.a_FREQ,
+                             aa_fitness          = fitness,
+                             aa_homogamy         = simulator.aa_HOMOGAMY,
+                             deaf                = simulator.DEAF_FREQ,
+                             generations         = generations,
+                             engine              = engine,
+                             seed                = 1)
+
+
+def bench_chooser(engine, pop_size, fitness, repeat):
+    '''
+        Times one generation of parent choosing: building the couple table
+        and drawing one parent pair for each offspring.
+
+        Accepts:
+        engine          a key of simulator.CHOOSERS
+        pop_size        population size, in thousands
+        fitness         aa_fitness, which sets the weights of couples with
+                        a deaf parent, e.g. 0.0 removes them
+        repeat          the number of runs
+    '''
+    simulation = simulator.Simulation(_experiment(pop_size, fitness, engine))
+    simulator.sim.initGenotype(simulation.pop, freq=[1-simulator.a_FREQ,
+                                                     simulator.a_FREQ])
+    size = simulation.pop.popSize()
+    chooser = simulator.CHOOSERS[engine]
+
+    def choose():
+        for _ in zip(range(size), chooser(simulation.pop, 0)):
+            pass
+    return measure(choose, repeat=repeat)
+
+
+def bench_simulation(engine, pop_size, fitness, generations, repeat):
+    '''
+        Times whole simulations (simuAssortativeMatingWithFitness, or the
+        aggregate engine) of a number of generations.
+    '''
+    e = _experiment(pop_size, fitness, engine, generations)
+    seeds = iter(simulator.replicate_seed(e.seed, i) for i in itertools.count())
+    if engine == 'aggregate':
+        return measure(lambda: simulator.aggregateAssortativeMatingWithFitness(
+                                    e, next(seeds)), repeat=repeat)
+    simulation = simulator.Simulation(e)
+    return measure(lambda: simulation.run(next(seeds)), repeat=repeat)
+
+
+def synthetic_file(folder, replicates, block=1000):
+    '''
+        Writes a tsv file of simulated data, as simulator.py --write would.
+        One block of replicates is simulated with the batched aggregate
+        engine on a small population and repeated, so that the values look
+        like real ones to the parser but large files are quick to make.
+
+        Accepts:
+        folder          the folder for the file
+        replicates      the number of replicates
+
+        Returns the filename.
+    '''
+    e = _experiment(1., simulator.aa_FITNESS, 'aggregate')
+    e.simulations = replicates
+    e.headers = simulator.FIELDS * e.generations
+    e.filename = os.path.join(folder, 'bench_{}.tsv'.format(replicates))
+    e.write_metadata(overwrite=True)
+    data = simulator.batchAssortativeMatingWithFitness(e, min(block, replicates),
+                        simulator.replicate_seed(e.seed, 0, min(block, replicates)))
+    with open(e.filename, 'a') as f:
+        for start in range(0, replicates, block):
+            e.write(data[:min(block, replicates - start)], f)
+    return e.filename
+
+
+def bench_io(filename, repeat):
+    '''
+        Times reading a tsv file: _read of the whole file, then select and
+        select_endpoint of one field, on an Experiment opened normally and
+        on one opened lazily. Every run opens a fresh Experiment, so no
+        cached columns are reused.
+
+        Returns a dict of measure results keyed by the operation.
+    '''
+    results = {}
+    results['_read'] = measure(lambda: fileio.Experiment(filename), repeat=repeat)
+    for lazy in (False, True):
+        opened = lambda: fileio.Experiment(filename, lazy=lazy)
+        suffix = ' (lazy)' if lazy else ''
+        results['select' + suffix] = measure(lambda e: e.select('aa'),
+                                             opened, repeat)
+        results['select_endpoint' + suffix] = measure(
+                                             lambda e: e.select_endpoint('aa'),
+                                             opened, repeat)
+    return results
+
+
+def bench_plotting(filename, folder, rcfname, repeat):
+    '''
+        Times violin_plot, with three violins, and contour_plot of the aa
+        field of a data file.
+
+        Returns a dict of measure results keyed by the function.
+    '''
+    e = fileio.Experiment(filename)
+    Ya = e.select('aa')
+    X = e.select('gen')[:,0]
+    violins = [Ya[-1], Ya[len(Ya)//2], Ya[0]]
+    output = os.path.join(folder, 'bench.png')
+    results = {}
+    results['violin_plot'] = measure(lambda: grapher.violin_plot(output,
+                                violins, rcfname=rcfname), repeat=repeat)
+    results['contour_plot'] = measure(lambda: grapher.contour_plot(output,
+                                X, Ya, rcfname=rcfname), repeat=repeat)
+    return results
+
+
+def _key(result):
+    '''
+        Internal function which identifies a benchmark across runs.
+    '''
+    return json.dumps([result['benchmark'], result['params']], sort_keys=True)
+
+
+def compare(old, new, threshold=0.1, floor=0.001):
+    '''
+        Compares two sets of results by their fastest times, which are the
+        least affected by other load on the machine.
+
+        Accepts:
+        old, new        results, as saved by bench.py
+        threshold       the fractional slowdown flagged as a regression
+        floor           slowdowns of fewer seconds than this are not
+                        flagged, as they are mostly timer noise
+
+        Returns a list of (benchmark, params, old time, new time,
+        regressed) tuples, for the benchmarks in both.
+    '''
+    before = {_key(result): result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        if _key(result) not in before:
+            continue
+        t0 = before[_key(result)]['best']
+        t1 = result['best']
+        rows.append((result['benchmark'], result['params'], t0, t1,
+                     t1 > t0*(1 + threshold) and t1 - t0 > floor))
+    return rows
+
+
+def _environment():
+    '''
+        Internal function which describes the commit and machine, so that
+        results can be matched to them.
+    '''
+    def git(*args):
+        try:
+            return subprocess.check_output(['git'] + list(args),
+                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                        stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    try:
+        cpu = subprocess.check_output(['/usr/sbin/sysctl', "-n", \
+                                      "machdep.cpu.brand_string"],
+                                      stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        cpu = platform.processor() or platform.machine()
+    return {'commit': git('rev-parse', 'HEAD'),
+            'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'cpu': '{} ({} threads)'.format(cpu, multiprocessing.cpu_count()),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'simuPOP': getattr(simulator.sim, '__version__', None)}
+
+
+#
+#   MAIN ROUTINE
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output',
+                        action = 'store',
+                        help = 'the JSON file to write (default ' \
+                               'bench_<commit>.json).')
+    parser.add_argument('--suite',
+                        action = 'store',
+                        nargs = '+',
+                        choices = SUITES,
+                        default = SUITES,
+                        help = 'the benchmarks to run (default all).')
+    parser.add_argument('-p', '--pop_size',
+                        action = 'store',
+                        nargs = '+',
+                        type = float,
+                        default = [10., 100., 1000.],
+                        help = 'population sizes, in thousands ' \
+                               '(default 10 100 1000).')
+    parser.add_argument('-f', '--fitness',
+                        action = 'store',
+                        nargs = '+',
+                        type = float,
+                        default = [0.0, 0.5, 1.0, 2.0],
+                        help = 'aa_fitness values (default 0.0 0.5 1.0 2.0).')
+    parser.add_argument('-e', '--engines',
+                        action = 'store',
+                        nargs = '+',
+                        choices = ['python', 'numpy', 'aggregate'],
+                        default = ['python', 'numpy', 'aggregate'],
+                        help = 'the engines to time; the choosers are timed ' \
+                               'for python and numpy (default all).')
+    parser.add_argument('-g', '--generations',
+                        action = 'store',
+                        type = int,
+                        default = 5,
+                        help = 'generations per timed simulation (default 5).')
+    parser.add_argument('-n', '--replicates',
+                        action = 'store',
+                        nargs = '+',
+                        type = int,
+                        default = [1000, 10000, 100000],
+                        help = 'replicates in the synthetic data files ' \
+                               '(default 1000 10000 100000).')
+    parser.add_argument('-r', '--repeat',
+                        action = 'store',
+                        type = int,
+                        default = 3,
+                        help = 'runs of each benchmark (default 3).')
+    parser.add_argument('--compare',
+                        action = 'store',
+                        help = 'an earlier JSON file to compare with.')
+    parser.add_argument('--threshold',
+                        action = 'store',
+                        type = float,
+                        default = 0.1,
+                        help = 'the slowdown flagged as a regression, as a ' \
+                               'fraction of the earlier time (default 0.1).')
+    args=parser.parse_args()
+
+    environment = _environment()
+    filename = args.output or 'bench_{}.json'.format(
+                                    (environment['commit'] or 'unknown')[:7])
+    random.seed(1)
+    numpy.random.seed(1)
+    rcfname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'print.rc')
+    results = []
+
+    def record(benchmark, params, result):
+        results.append(dict(benchmark=benchmark, params=params, **result))
+        print('   {:<24} {:<56} {:>10.4f} s'.format(benchmark,
+              ', '.join('{}={}'.format(*item) for item in params.items()),
+              result['median']))
+
+    if 'simulation' in args.suite:
+        print('Timing simulations...')
+        for engine, pop_size, fitness in itertools.product(args.engines,
+                                                           args.pop_size,
+                                                           args.fitness):
+            params = {'engine': engine, 'pop_size': pop_size, 'aa_fitness': fitness}
+            if engine in simulator.CHOOSERS:
+                record(simulator.CHOOSERS[engine].__name__, params,
+                       bench_chooser(engine, pop_size, fitness, args.repeat))
+            params = dict(params, generations=args.generations)
+            record('simulation', params, bench_simulation(engine, pop_size,
+                        fitness, args.generations, args.repeat))
+
+    if 'io' in args.suite or 'plotting' in args.suite:
+        with tempfile.TemporaryDirectory() as folder:
+            for replicates in args.replicates:
+                print('Writing a synthetic file of {} replicates...'.format(replicates))
+                data = synthetic_file(folder, replicates)
+                params = {'replicates': replicates}
+                if 'io' in args.suite:
+                    print('Timing file I/O...')
+                    for name, result in bench_io(data, args.repeat).items():
+                        record(name, params, result)
+                if 'plotting' in args.suite:
+                    print('Timing plots...')
+                    for name, result in bench_plotting(data, folder, rcfname,
+                                                       args.repeat).items():
+                        record(name, params, result)
+                os.remove(data)
+
+    print('Saving file...\n   {}'.format(filename))
+    with open(filename, 'w') as f:
+        json.dump({'environment': environment, 'repeat': args.repeat,
+                   'results': results}, f, indent=1)
+
+    regressed = False
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('Comparing with {} ({})...'.format(args.compare,
+              old['environment'].get('commit')))
+        for benchmark, params, t0, t1, slower in compare(old, {'results': results},
+                                                         args.threshold):
+            regressed = regressed or slower
+            print('   {:<24} {:<56} {:>10.4f} {:>10.4f} {:>+8.1%}{}'.format(
+                  benchmark, ', '.join('{}={}'.format(*item) for item in params.items()),
+                  t0, t1, t1/t0 - 1, '  REGRESSION' if slower else ''))
+    print('Done.')
+    sys.exit(1 if regressed else 0)
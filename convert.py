@@ -0,0 +1,56 @@
+#!/usr/local/bin/python3 -u
+# -*- coding: utf-8 -*-
+# We generally follow PEP 8: http://legacy.python.org/dev/peps/pep-0008/
+
+'''
+*Derek C. Braun, Brian H. Greenwald, Samir Jain, Eric Epstein, Brienna Herold, Maggie Gray
+(*derek.braun@gallaudet.edu)
+
+Converts data files created by simulator.py between the .tsv format and the
+binary format read by fileio.Experiment. Each file is converted to the other
+format, next to the original.
+'''
+
+import os
+import sys
+import argparse
+import fileio
+
+#
+#   MAIN ROUTINE
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames',
+                        nargs = '+',
+                        help = 'filename(s) for data file(s)')
+    parser.add_argument('-o', '--overwrite',
+                        action = 'store_true',
+                        help = 'overwrite converted files that already exist.')
+    args=parser.parse_args()
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    print('Converting file(s)...')
+    for filename in args.filenames:
+        if not os.path.isfile(filename):
+            print('   File {} not found.'.format(filename))
+            continue
+        binary = filename.endswith(fileio.BINARY_EXT)
+        output = os.path.splitext(filename)[0] + \
+                 ('.tsv' if binary else fileio.BINARY_EXT)
+        if os.path.isfile(output) and not args.overwrite:
+            print('   File {} already exists. Use --overwrite.'.format(output))
+            continue
+        e = fileio.Experiment(filename)
+        if binary:
+            cube = e.array()
+            e.filename = output
+            e.write_metadata(overwrite=True)
+            e.write(cube)
+        else:
+            e.write_binary(output)
+        print('   {} -> {}'.format(filename, output))
+    print('Done.')
@@ -20,7 +20,15 @@ METADATA = ['experiment_date',
             'a',
             'aa_fitness',
             'deaf',
-            'aa_homogamy']
+            'aa_homogamy',
+            'engine',
+            'batch',
+            'simulations',
+            'seed',
+            'shard',
+            'tolerance',
+            'replicates',
+            'ci_width']
 
 INDEP_VARS = ['constant_pop_size',
             'generations',
@@ -30,10 +38,27 @@ INDEP_VARS = ['constant_pop_size',
             'aa_homogamy']
 
 import os
+import io
 import time
 import csv
+import json
+import struct
+import shutil
 import numpy
 
+# Binary files hold the metadata and header schema as JSON, followed by the
+# data as little-endian float64 stored field by field, then generation by
+# generation, so that one field, or one field at one generation, is a
+# contiguous run of bytes.
+BINARY_EXT = '.bin'
+BINARY_MAGIC = b'HOMOGAMY'
+BINARY_ALIGN = 64
+
+# Summaries derived from a data file, e.g. percentiles or sorted endpoint
+# values, are kept in a cache file next to it. The cache records the data
+# file's size and modification time, and is ignored once either changes.
+CACHE_EXT = '.cache.npz'
+
 
 def create_folder(path):
     '''
@@ -60,13 +85,23 @@ class Experiment:
 
         This code is written to be very flexible. The names of the metadata
         headers are stored in the global variable METADATA.
+
+        Data are available as self.cube, an array of shape (replicates,
+        generations, fields). Files ending in BINARY_EXT are binary files,
+        which are memory-mapped when read, so reading part of self.cube only
+        reads those bytes from disk.
     '''
-    def __init__(self, filename=None, **kwargs):
+    def __init__(self, filename=None, lazy=False, **kwargs):
         '''
             If a filename is defined, that file will be opened and the file
             data will populate this class. Metadata in the file will
             become variables in the class scope.
 
+            If lazy is True, only the metadata and headers of a tsv file
+            are read when it is opened. select and select_endpoint then
+            stream the data rows, pulling out only the columns requested,
+            so memory use does not grow with the size of the file.
+
             If a filename is not defined, then metadata should be passed
             to __init__ as kwargs. They will become variables
             in the class scope.
@@ -80,9 +115,15 @@ class Experiment:
                     setattr(self, key, None)
             self.experiment_date = time.strftime('%Y %b %d')
             self.headers = None
+            self.cube = None
         elif filename is not None and len(kwargs) == 0:
             self.filename = filename
-            self._read()
+            self.cube = None
+            self.lazy = lazy
+            if filename.endswith(BINARY_EXT):
+                self._read_binary()
+            else:
+                self._read()
         elif filename is not None and len(kwargs) > 0:
             raise BaseException('You cannot pass both a filename and metadata'\
                                  ' to Experiment.__init__.')
@@ -102,7 +143,7 @@ class Experiment:
         else:
             h = []
             for param in METADATA:
-                h += [['# {} = {}'.format(param, getattr(self, param))]]
+                h += [['# {} = {}'.format(param, getattr(self, param, None))]]
             h += [self.headers]
             f = open(self.filename,'w')
             o = csv.writer(f, dialect=csv.excel_tab)
@@ -110,6 +151,32 @@ class Experiment:
             f.close()
             return True
 
+    def rewrite_metadata(self):
+        '''
+            Rewrites the metadata of self.filename, e.g. once values known
+            only at the end of a run are set. The headers and data rows are
+            copied verbatim, and the file is replaced atomically.
+        '''
+        temp = self.filename + '.tmp'
+        f = open(self.filename, 'rb')
+        line = f.readline()
+        while line.startswith(b'#'):
+            line = f.readline()
+        out = open(temp, 'w')
+        o = csv.writer(out, dialect=csv.excel_tab)
+        o.writerows([['# {} = {}'.format(param, getattr(self, param, None))]
+                     for param in METADATA])
+        out.flush()
+        out = out.detach()
+        out.write(line)
+        shutil.copyfileobj(f, out)
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        f.close()
+        os.replace(temp, self.filename)
+
+
     def metadata(self):
         '''
             Returns a string with all the metadata.
@@ -121,85 +188,544 @@ class Experiment:
         return s
 
 
-    def write(self, rows):
+    def write(self, rows, f=None):
         '''
             Appends a block of data to an existing .tsv file. Should be
             called repeatedly as more data become available.
 
-            Accepts:    rows    a list of rows of columns
+            Accepts:    rows    a list of rows of columns, or a numpy array
+                                of shape (replicates, generations, fields)
+                        f       an optional file object already open for
+                                appending to self.filename, so that
+                                repeated writes don't reopen the file
 
             Returns:    True    if successful
                         False   if self.filename file doesn't exist
         '''
+        if isinstance(rows, numpy.ndarray):
+            rows = rows.reshape(len(rows), -1).tolist()
         if os.path.isfile(self.filename):
-            f = open(self.filename,'a')
-            o = csv.writer(f, dialect=csv.excel_tab)
+            # The block is formatted in memory and appended with a single
+            # write, then fsync'd, so that a crash can tear at most the
+            # last block. count_rows(trim=True) removes a torn block.
+            s = io.StringIO()
+            o = csv.writer(s, dialect=csv.excel_tab)
             o.writerows(rows)
-            f.close()
+            if f is None:
+                with open(self.filename,'a') as f:
+                    f.write(s.getvalue())
+                    f.flush()
+                    os.fsync(f.fileno())
+            else:
+                f.write(s.getvalue())
+                f.flush()
+                os.fsync(f.fileno())
             return True
         else:
             return False
 
 
+    def count_rows(self, trim=False):
+        '''
+            Counts the complete data rows in self.filename. A row is complete
+            if it ends with a line terminator, has one column per header
+            and every column is a number. Anything after the first
+            incomplete row is the result of a torn write.
+
+            Accepts:
+                trim            if True, the file is truncated after the
+                                last complete row
+
+            Returns the number of complete rows, or None if self.filename
+            doesn't exist.
+        '''
+        if not os.path.isfile(self.filename):
+            return None
+        f = open(self.filename, 'r+b')
+        columns = None
+        rows = 0
+        end = 0
+        for line in f:
+            if line.startswith(b'#'):
+                end += len(line)
+                continue
+            if not line.endswith(b'\n'):
+                break
+            fields = line.rstrip(b'\r\n').split(b'\t')
+            if columns is None:
+                columns = len(fields)
+            else:
+                if len(fields) != columns:
+                    break
+                try:
+                    [float(x) for x in fields]
+                except ValueError:
+                    break
+                rows += 1
+            end += len(line)
+        if trim and end < os.path.getsize(self.filename):
+            f.truncate(end)
+            os.fsync(f.fileno())
+        f.close()
+        return rows
+
+
     def _read(self):
         '''
             Internal method to extract data and experimental parameters from a
             tsv file. Populates the class with data.
 
+            The numeric body is parsed directly into one float64 array, which
+            the header pattern (the same fields repeated once per generation)
+            reshapes into self.cube, of shape (replicates, generations,
+            fields).
+
             Returns:    True    if successful
                         False   if file not found
         '''
         if os.path.isfile(self.filename):
-            f = open(self.filename,'r')
-            rows = csv.reader(f, dialect=csv.excel_tab)
-            self.data = []
-            for row in rows:
+            f = open(self.filename,'r', newline='')
+            line = f.readline()
+            while line:
+                row = next(csv.reader([line], dialect=csv.excel_tab))
                 if '#' in row[0] and '=' in row[0]:
                     key = row[0].replace('#','').split('=')[0].strip()
                     value = row[0].replace('#','').split('=')[1].strip()
                     if not hasattr(self, key):
                         setattr(self, key, value)
+                    line = f.readline()
                     continue
-                if not hasattr(self, 'headers'):
-                    self.headers = row
-                else:
-                    self.data += [row]
-            # This clever Python shorthand transposes a table. It will cause data
-            # truncation if the table does not have consistent dimensions.
-            self.data = list(zip(*self.data))
+                self.headers = row
+                break
+            if not hasattr(self, 'headers'):
+                self.headers = []
+            self.fields = _fields(self.headers)
+            self._body = f.tell()
+            if getattr(self, 'lazy', False):
+                f.close()
+                return True
+            lines = _complete(f.read().splitlines(True), len(self.headers))
+            f.close()
+            if len(lines) > 0:
+                data = numpy.loadtxt(lines, delimiter='\t', dtype=float, ndmin=2)
+            else:
+                data = numpy.zeros((0, len(self.headers)))
+            # the generations come from the headers, so that a file with no
+            # rows yet, e.g. from a run killed before its first write, opens
+            generations = len(self.headers)//len(self.fields) if len(self.fields) > 0 else 0
+            self.cube = data.reshape(len(lines), generations, len(self.fields))
+            self.cube.flags.writeable = False
             return True
         return False
 
 
+    def select_columns(self, columns, chunk=10000):
+        '''
+            Streams the data rows of a tsv file and pulls out only the
+            requested columns, reading chunk rows at a time.
+
+            Accepts
+                columns         a list of (field, generation) tuples;
+                                generation may be negative, e.g. -1 for
+                                the endpoint
+                chunk           the number of rows held in memory at once
+
+            Returns a list with a float array for each column.
+        '''
+        generations = len(self.headers)//len(self.fields)
+        usecols = [(g % generations)*len(self.fields) + self.fields.index(field)
+                   for field, g in columns]
+        blocks = []
+        f = open(self.filename, 'r', newline='')
+        f.seek(self._body)
+        while True:
+            lines = f.readlines(chunk * len(self.headers) * 8)
+            if len(lines) == 0:
+                break
+            lines = _complete(lines, len(self.headers))
+            if len(lines) > 0:
+                blocks.append(numpy.loadtxt(lines, delimiter='\t', dtype=float,
+                                            usecols=usecols, ndmin=2))
+        f.close()
+        if len(blocks) == 0:
+            return [numpy.array([], dtype=float) for c in columns]
+        data = numpy.concatenate(blocks)
+        return [data[:,j] for j in range(len(columns))]
+
+
+    def _read_binary(self):
+        '''
+            Internal method to extract data and experimental parameters from a
+            binary file. The data are memory-mapped, not read.
+
+            Returns:    True    if successful
+                        False   if file not found
+        '''
+        if os.path.isfile(self.filename):
+            f = open(self.filename, 'rb')
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                f.close()
+                raise ValueError('{} is not a binary data file.'.format(self.filename))
+            length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length).decode())
+            f.close()
+            for key, value in header['metadata'].items():
+                setattr(self, key, value)
+            self.fields = header['fields']
+            shape = tuple(header['shape'])
+            self.headers = self.fields * shape[1]
+            offset = _binary_offset(length)
+            if shape[2] > 0:
+                m = numpy.memmap(self.filename, dtype='<f8', mode='r',
+                                 offset=offset, shape=shape)
+                self.cube = m.transpose(2, 1, 0)
+            else:
+                self.cube = numpy.zeros(shape[::-1])
+            return True
+        return False
+
+
+    def array(self):
+        '''
+            Returns the data as a float array of shape
+            (replicates, generations, fields). A lazy Experiment reads all
+            of its data.
+        '''
+        if self.cube is None:
+            self.lazy = False
+            self._read()
+        return self.cube
+
+
+    def write_binary(self, filename):
+        '''
+            Writes metadata, the header schema and the data to a binary
+            file, which can then be opened with Experiment(filename).
+
+            Accepts:
+                filename        the file to be written; it should end with
+                                BINARY_EXT
+        '''
+        cube = self.array()
+        fields = self.headers[:cube.shape[2]]
+        metadata = {}
+        for param in METADATA:
+            if hasattr(self, param):
+                metadata[param] = '{}'.format(getattr(self, param))
+        header = json.dumps({'metadata': metadata,
+                             'fields': fields,
+                             'shape': cube.shape[::-1]}).encode()
+        f = open(filename, 'wb')
+        f.write(BINARY_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (_binary_offset(len(header)) - f.tell()))
+        # field by field, so that each field is contiguous on disk
+        for i in range(cube.shape[2]):
+            f.write(numpy.ascontiguousarray(cube[:,:,i].T, dtype='<f8').tobytes())
+        f.close()
+
+
+    def _column(self, param):
+        '''
+            Internal method which returns the index of field param in
+            self.cube, or None if there is no such field. The field index
+            is built once, the first time it is needed.
+        '''
+        if not hasattr(self, '_index'):
+            self._index = {field: i for i, field in enumerate(self.fields)}
+            self._cache = {}
+        return self._index.get(param)
+
+
     def select(self, param, row=None):
         '''
             Selects data columns with name param. Optional row argument allows
-            for selection of both a column and a row.
+            for selection of both a column and a row. Fields are matched
+            exactly, so 'a' does not match 'aa' or 'Aa'.
 
             Accepts
                 param           the field to be selected
                 row             an optional row index
 
-            Returns a numpy array with dtype float.
+            Returns a read-only numpy array with dtype float, with shape
+            (generations, replicates), or (generations,) if row is given.
+            Arrays for whole fields are cached, so repeated calls are free.
         '''
-        l = []
-        for h, col in zip(self.headers, self.data):
-            if row is None:
-                if param == h:
-                    l.append(col)
+        i = self._column(param)
+        if i is None:
+            return numpy.array([], dtype=float)
+        if row is not None:
+            if self.cube is None:
+                return self.select(param)[:,row]
+            return self.cube[row,:,i]
+        if param not in self._cache:
+            if self.cube is None:
+                generations = len(self.headers)//len(self.fields)
+                X = numpy.array(self.select_columns([(param, g)
+                                    for g in range(generations)]), ndmin=2)
             else:
-                if param in h:
-                    l.append(col[row])
-        return numpy.array(l, dtype=float)
+                X = numpy.ascontiguousarray(self.cube[:,:,i].T, dtype=float)
+            X.flags.writeable = False
+            self._cache[param] = X
+        return self._cache[param]
 
 
     def select_endpoint(self, param):
         '''
-            Convenience function to select the endpoint data.
+            Convenience function to select the endpoint data. Only the last
+            generation of the field is read.
 
             Accepts
                 param         the field to be selected
 
-            Returns a numpy array with dtype float.
+            Returns a read-only numpy array with dtype float.
         '''
-        return self.select(param)[-1]
+        if param in getattr(self, '_cache', {}):
+            return self._cache[param][-1]
+        i = self._column(param)
+        if i is None:
+            return numpy.array([], dtype=float)
+        key = (param, 'endpoint')
+        if key not in self._cache:
+            if self.cube is None:
+                X = self.select_columns([(param, -1)])[0]
+            else:
+                X = numpy.ascontiguousarray(self.cube[:,-1,i], dtype=float)
+            X.flags.writeable = False
+            self._cache[key] = X
+        return self._cache[key]
+
+
+    def summary(self, key, compute):
+        '''
+            Returns a summary derived from the data, from the cache file next
+            to the data file. If the summary is not cached, or the data file
+            has changed since it was, it is computed and stored.
+
+            Accepts
+                key             a string naming the summary
+                compute         a function that returns the summary as an
+                                array
+
+            Returns a read-only numpy array.
+        '''
+        entries = self._summaries()
+        if key not in entries:
+            X = numpy.asarray(compute())
+            entries[key] = X
+            _save_summaries(self.filename, self._summary_stamp, {key: X})
+        X = entries[key]
+        X.flags.writeable = False
+        return X
+
+
+    def _summaries(self):
+        '''
+            Internal method which loads the cached summaries once, the first
+            time they are needed.
+        '''
+        if not hasattr(self, '_summary_cache'):
+            # the version is noted before any data are read, so a summary
+            # is never stored under a newer version than it was computed from
+            self._summary_stamp = _stamp(self.filename)
+            self._summary_cache = _load_summaries(self.filename,
+                                                  self._summary_stamp)
+        return self._summary_cache
+
+
+    def sorted_endpoint(self, param):
+        '''
+            Returns the endpoint data of param, sorted. Cached.
+        '''
+        return self.summary('sorted_endpoint:{}'.format(param),
+                            lambda: numpy.sort(self.select_endpoint(param)))
+
+
+    def sorted_endpoints(self, params):
+        '''
+            Returns sorted_endpoint for several fields. The endpoints that
+            are not cached are read together, in one pass over a tsv file.
+
+            Accepts
+                params          a list of fields
+
+            Returns a list of read-only numpy arrays.
+        '''
+        missing = [param for param in params
+                   if 'sorted_endpoint:{}'.format(param) not in self._summaries()
+                   and self._column(param) is not None]
+        if self.cube is None and len(missing) > 1:
+            columns = self.select_columns([(param, -1) for param in missing])
+            for param, X in zip(missing, columns):
+                self.summary('sorted_endpoint:{}'.format(param),
+                             lambda: numpy.sort(X))
+        return [self.sorted_endpoint(param) for param in params]
+
+
+    def median(self, param):
+        '''
+            Returns the median of the endpoint data of param. Cached.
+        '''
+        return float(self.summary('median:{}'.format(param),
+                     lambda: numpy.median(self.select_endpoint(param))))
+
+
+    def percentiles(self, param, q):
+        '''
+            Returns percentiles of param for each generation. Cached.
+
+            Accepts
+                param           the field
+                q               a sequence of percentiles, from 0 to 100
+
+            Returns a read-only float array of shape (len(q), generations).
+        '''
+        key = 'percentiles:{}:{}'.format(param, ','.join(str(p) for p in q))
+        return self.summary(key, lambda: numpy.percentile(self.select(param),
+                                                           q, axis=1))
+
+
+def _stamp(filename):
+    '''
+        Returns the size and modification time of a data file, which key its
+        cache entries.
+    '''
+    stat = os.stat(filename)
+    return numpy.array([stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+
+
+def _load_summaries(filename, stamp):
+    '''
+        Returns the cached summaries for the version of a data file with the
+        given stamp as a dict, or an empty dict if there are none.
+    '''
+    try:
+        with numpy.load(filename + CACHE_EXT) as f:
+            if (f['_stamp'] == stamp).all():
+                return {key: f[key] for key in f.files if key != '_stamp'}
+    except (OSError, KeyError, ValueError):
+        pass
+    return {}
+
+
+def _save_summaries(filename, stamp, entries):
+    '''
+        Adds entries for the version of a data file with the given stamp to
+        its cache file. Entries stored meanwhile by another process are
+        kept, and the file is replaced atomically. Nothing is stored if the
+        data file has changed, or if the cache cannot be written, e.g. in a
+        read-only folder.
+    '''
+    if not (_stamp(filename) == stamp).all():
+        return
+    entries = dict(_load_summaries(filename, stamp), **entries)
+    temp = '{}.{}.tmp'.format(filename + CACHE_EXT, os.getpid())
+    try:
+        with open(temp, 'wb') as f:
+            numpy.savez(f, _stamp=stamp, **entries)
+        os.replace(temp, filename + CACHE_EXT)
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def _complete(lines, columns):
+    '''
+        Returns the complete lines of a tsv body. Lines torn by an
+        interrupted write, those without a line terminator or with the
+        wrong number of columns, are dropped.
+    '''
+    return [l for l in lines if l.endswith('\n') and l.count('\t') == columns - 1]
+
+
+def _fields(headers):
+    '''
+        Returns the fields of one generation, given headers in which the
+        same fields repeat once per generation. If they don't repeat, every
+        header is a field and there is one generation.
+    '''
+    if len(headers) > 1 and headers[0] in headers[1:]:
+        fields = headers[:headers.index(headers[0], 1)]
+        if headers == fields * (len(headers)//len(fields)):
+            return fields
+    return list(headers)
+
+
+def _binary_offset(length):
+    '''
+        Returns the offset of the data in a binary file with a JSON header of
+        the given length, aligned to BINARY_ALIGN bytes.
+    '''
+    offset = len(BINARY_MAGIC) + 8 + length
+    return offset + (-offset) % BINARY_ALIGN
+
+
+def merge(filenames, filename, overwrite=False):
+    '''
+        Merges the shard files written by simulator.py --shard into one
+        file. The shards must be complete, must cover shards 1 to N exactly
+        once and must have identical headers and metadata, apart from the
+        shard, cpu and experiment_date. Data rows are copied verbatim in
+        shard order, so the merged file is in replicate order.
+
+        Accepts:
+            filenames       the shard files, in any order
+            filename        the merged file to be written
+            overwrite       True or False
+
+        Returns the merged Experiment. Raises ValueError if the shards
+        cannot be merged.
+    '''
+    shards = []
+    for name in filenames:
+        e = Experiment(name)
+        if str(getattr(e, 'shard', None)) == 'None':
+            raise ValueError('{} is not a shard file.'.format(name))
+        i, n = [int(x) for x in e.shard.split('/')]
+        shards.append((i, n, e))
+    shards.sort(key=lambda shard: shard[0])
+    i0, n0, e0 = shards[0]
+    if [(i, n) for i, n, e in shards] != [(i+1, n0) for i in range(n0)]:
+        raise ValueError('Shards {} do not cover 1/{n} to {n}/{n} exactly once.'\
+                         ''.format([e.shard for i, n, e in shards], n=n0))
+    params = [p for p in METADATA if p not in ('shard', 'cpu', 'experiment_date')]
+    for i, n, e in shards:
+        for p in params:
+            if getattr(e, p, None) != getattr(e0, p, None):
+                raise ValueError('{} has {} = {}, but {} has {}.'\
+                                 ''.format(e.filename, p, getattr(e, p, None),
+                                           e0.filename, getattr(e0, p, None)))
+        if e.headers != e0.headers:
+            raise ValueError('{} has different headers.'.format(e.filename))
+        # the same arithmetic as simulator.shard_range
+        rows = e.count_rows()
+        simulations = int(e.simulations)
+        expected = i*simulations//n - (i-1)*simulations//n
+        if rows != expected:
+            raise ValueError('{} has {:,} of {:,} rows; resume it first.'\
+                             ''.format(e.filename, rows, expected))
+
+    merged = Experiment(**{p: getattr(e0, p, None) for p in params})
+    merged.experiment_date = e0.experiment_date
+    merged.cpu = '; '.join(sorted(set(str(e.cpu) for i, n, e in shards)))
+    merged.headers = e0.headers
+    merged.filename = filename
+    if not merged.write_metadata(overwrite=overwrite):
+        raise ValueError('{} already exists.'.format(filename))
+    out = open(filename, 'ab')
+    for i, n, e in shards:
+        f = open(e.filename, 'rb')
+        header = None
+        for line in f:
+            if line.startswith(b'#'):
+                continue
+            if header is None:
+                header = line
+                continue
+            out.write(line)
+        f.close()
+    out.flush()
+    os.fsync(out.fileno())
+    out.close()
+    return merged
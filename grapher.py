@@ -17,27 +17,118 @@ AXIS_LABELS = {'a'  : 'Allelic frequency',
 
 import os
 import sys
+import glob
+import json
+import shlex
+import hashlib
 import argparse
+import multiprocessing
 import numpy
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt, lines
 import fileio
+import sketch
+import my_math
 
 #see: http://matplotlib.sourceforge.net/users/customizing.html
 BLUE = '#00457c'
 BUFF = '#e8d4a2'
+# the percentiles drawn by contour_plot; 100 sets the y limit
+CONTOUR_PERCENTILES = [100, 98, 75, 50, 25, 2]
+
+
+def violin_density(X, points=100, bins=512):
+    '''
+        Estimates the density of a violin: a Gaussian kernel density
+        estimate with Scott's bandwidth, the default of ax.violinplot. The
+        values are linearly binned onto a fine grid, which is convolved with
+        the kernel by FFT, so the cost hardly grows with the number of
+        values.
+
+        Accepts:
+            X               an array of values
+            points          the number of points returned, from the minimum
+                            to the maximum of X
+            bins            the minimum number of grid bins
+
+        Returns a float array of shape (2, points): the coordinates and the
+        densities at them.
+    '''
+    X = numpy.asarray(X, dtype=float)
+    low, high = X.min(), X.max()
+    coords = numpy.linspace(low, high, points)
+    h = X.std(ddof=1) * len(X)**-0.2 if len(X) > 1 else 0.
+    if h == 0 or high == low:
+        return numpy.array([coords, numpy.ones(points)])
+    # keep several bins per bandwidth, even for long tails
+    bins = int(min(2**16, max(bins, 4*(high-low)/h)))
+    delta = (high-low)/(bins-1)
+    t = (X-low)/delta
+    i = numpy.minimum(t.astype(int), bins-2)
+    w = t - i
+    counts = numpy.bincount(i, 1-w, bins) + numpy.bincount(i+1, w, bins)
+    # the kernel is cut off at 5 bandwidths
+    L = min(bins-1, int(numpy.ceil(5*h/delta)))
+    kernel = numpy.exp(-0.5*(numpy.arange(-L, L+1)*delta/h)**2) / \
+             (h*numpy.sqrt(2*numpy.pi)*len(X))
+    size = 1 << (bins + 2*L - 1).bit_length()
+    density = numpy.fft.irfft(numpy.fft.rfft(counts, size) *
+                              numpy.fft.rfft(kernel, size), size)[L:L+bins]
+    grid = low + delta*numpy.arange(bins)
+    return numpy.array([coords, numpy.interp(coords, grid,
+                                             numpy.maximum(density, 0))])
+
+
+def expected_values(e, param):
+    '''
+        Returns the expected values of param for each generation of an
+        Experiment, from the Crow & Felsenstein (1968) recursion, or None if
+        the recursion does not give param. The recursion has no selection,
+        so it only fits experiments with aa_fitness 1.0.
+    '''
+    r, aa = my_math.crowFelsenstein(float(e.aa_homogamy), float(e.a),
+                                    float(e.deaf), int(float(e.generations)))
+    if param == 'aa':
+        return aa
+    if param == 'a':
+        # without selection, allele frequencies do not change
+        return numpy.full(aa.shape, float(e.a))
+    print('   No expected values for {}.'.format(param))
+    return None
+
+
+def endpoint_density(e, param):
+    '''
+        Returns violin_density of the endpoint data of param in an
+        Experiment, cached with the file's other summaries.
+    '''
+    return e.summary('violin_density:{}'.format(param),
+                     lambda: violin_density(e.sorted_endpoint(param)))
+
+
+def _violin(ax, X, density, positions):
+    '''
+        Draws violins from densities made by violin_density, as
+        ax.violinplot would with showmedians=True and showextrema=False.
+    '''
+    vpstats = [{'coords': d[0], 'vals': d[1], 'mean': numpy.mean(x),
+                'median': numpy.median(x), 'min': d[0][0], 'max': d[0][-1]}
+               for x, d in zip(X, density)]
+    ax.violin(vpstats, positions=positions, showmeans=False,
+              showmedians=True, showextrema=False)
 
 
 def violin_plot(filename, violins, title=None, xlabel=None, categories=None,
                 ylabel=None, ylim=None, yformat='{x:.3%}', yscale='linear',
-                rc=None, rcfname=None):
+                rc=None, rcfname=None, densities=None):
     '''
         Produces a violin plot.
 
         Accepts:
             filename        the file to be written
-            violins         a multi-dimensional array of Y values
+            violins         a list of arrays of Y values, one per violin;
+                            they need not be the same length
             title           the plot title
             xlabel          x axis label string
             categories      x axis categories (strings)
@@ -48,7 +139,11 @@ def violin_plot(filename, violins, title=None, xlabel=None, categories=None,
             rc              a rcparams dict. This takes precedence over
                             rcfname.
             rcfname         a rcparams file to load to set graph style.
+            densities       optional densities of the violins, from
+                            violin_density, e.g. cached per file
     '''
+    if densities is None:
+        densities = [violin_density(X) for X in violins]
     with matplotlib.rc_context(rc=rc, fname=rcfname):
         plt.clf()
         fig = plt.figure()
@@ -57,7 +152,7 @@ def violin_plot(filename, violins, title=None, xlabel=None, categories=None,
         ax = fig.add_subplot(111)
         ax.set_yscale(yscale)
         ax.set_ylim(0.001 if yscale == 'log' else 0,
-                    numpy.amax(violins)*1.1 if ylim is None else ylim)
+                    max(numpy.amax(X) for X in violins)*1.1 if ylim is None else ylim)
         if xlabel is not None:
             ax.set_xlabel(xlabel)
         if ylabel is not None:
@@ -67,9 +162,11 @@ def violin_plot(filename, violins, title=None, xlabel=None, categories=None,
                 ax.set_ylabel(ylabel, rotation=0)
             else:
                 ax.set_ylabel(ylabel)
-        ax.violinplot(violins, showmeans = False, showmedians = True,
-                      showextrema = False)
-        Y_98, Y_75, Y_50, Y_25, Y_2 = numpy.percentile(violins, [98, 75, 50, 25, 2], axis=1)
+        _violin(ax, violins, densities, numpy.arange(1, len(violins) + 1))
+        # one violin at a time, as files may hold different numbers of
+        # replicates, e.g. from an adaptive sweep
+        Y_98, Y_75, Y_50, Y_25, Y_2 = numpy.array([numpy.percentile(X,
+                                        [98, 75, 50, 25, 2]) for X in violins]).T
         inds = numpy.arange(1, len(Y_50) + 1)
         ax.vlines(inds, Y_25, Y_75, linestyle='-', lw=5)
         ax.vlines(inds, Y_2, Y_98, linestyle='-', lw=1)
@@ -86,7 +183,8 @@ def violin_plot(filename, violins, title=None, xlabel=None, categories=None,
 
 
 def contour_plot(filename, X, Ya, title=None, xlabel=None, ylabel=None,
-                 ylim=None, yformat='{x:.3%}', rc=None, rcfname=None):
+                 ylim=None, yformat='{x:.3%}', rc=None, rcfname=None,
+                 percentiles=None, density=None, expected=None):
     '''
         Produces a contour plot that is like a continuous boxplot.
         The 25% and 75% quartiles, median, 2% and 98% credible intervals are all
@@ -105,9 +203,22 @@ def contour_plot(filename, X, Ya, title=None, xlabel=None, ylabel=None,
             rc              a rcparams dict. This takes precedence over
                             rcfname.
             rcfname         a rcparams file to load to set graph style.
+            percentiles     optional CONTOUR_PERCENTILES of each generation,
+                            e.g. from Experiment.percentiles. If given, Ya
+                            need only hold the last generation's values.
+            density         optional density of the last generation's
+                            values, from violin_density
+            expected        optional expected values for each generation,
+                            e.g. from my_math.crowFelsenstein, drawn as a
+                            dashed line
     '''
 
-    Y_98, Y_75, Y_50, Y_25, Y_2 = numpy.percentile(Ya, [98, 75, 50, 25, 2], axis=1)
+    if percentiles is None:
+        percentiles = numpy.percentile(Ya, CONTOUR_PERCENTILES, axis=1)
+        Ya = Ya[-1]
+    if density is None:
+        density = violin_density(Ya)
+    Y_100, Y_98, Y_75, Y_50, Y_25, Y_2 = percentiles
 
     with matplotlib.rc_context(rc=rc, fname=rcfname):
         plt.clf()
@@ -119,7 +230,7 @@ def contour_plot(filename, X, Ya, title=None, xlabel=None, ylabel=None,
         #if title is not None:
         #    plt.title(title, ha='right')
         ax1.set_xlim(0,max(X))                            # necessary to have the graph start at 0,0
-        ax1.set_ylim(0,numpy.amax(Ya) if ylim is None else ylim)  # necessary to have the graph start at 0,0
+        ax1.set_ylim(0,numpy.amax(Y_100) if ylim is None else ylim)  # necessary to have the graph start at 0,0
         if xlabel is not None:
             ax1.set_xlabel(xlabel)
         if ylabel is not None:
@@ -135,9 +246,11 @@ def contour_plot(filename, X, Ya, title=None, xlabel=None, ylabel=None,
         ax1.plot(X, Y_50, color=BLUE, lw=1.5)
         ax1.plot(X, Y_25, color=BLUE)
         ax1.plot(X, Y_2, color=BLUE, lw=0.5)
+        if expected is not None:
+            ax1.plot(X[:len(expected)], expected[:len(X)], color='black',
+                     lw=1, linestyle='--')
 
-        ax2.violinplot(Ya[-1], showmeans = False, showmedians = True,
-                      showextrema = False)
+        _violin(ax2, [Ya], [density], [1])
         ax2.vlines([1], Y_25[-1], Y_75[-1], linestyle='-', lw=4)
         ax2.vlines([1], Y_2[-1], Y_98[-1], linestyle='-', lw=1)
         ax2.text(1.2, Y_2[-1], yformat.format(x=Y_2[-1]),
@@ -150,6 +263,275 @@ def contour_plot(filename, X, Ya, title=None, xlabel=None, ylabel=None,
         plt.savefig(filename, transparent=True, dpi=600)
         plt.close()
 
+def output_filename(args):
+    '''
+        Returns the output filename of a figure: args.output_file, or a name
+        derived from the first data file and the figure type.
+
+        Accepts:
+            args            the parsed command line arguments of one figure
+    '''
+    if args.output_file:
+        return args.output_file
+    plot_type = 'contour_plot' if len(args.filenames) == 1 else 'violin_plot'
+    return os.path.splitext(args.filenames[0])[0] + \
+           '.{plot_type}.{args.field}.{args.rcfname}.pdf'.format(**locals())
+
+
+def read_files(filenames, use_sketch=False):
+    '''
+        Opens data files, and their quantile sketches if use_sketch is True.
+
+        Returns lists of Experiment and QuantileSketch objects, or None if a
+        file is missing.
+    '''
+    experiments = []
+    sketches = []
+    for filename in filenames:
+        # Check to see if each individual file exists
+        if os.path.isfile(filename):
+            experiments.append(fileio.Experiment(filename, lazy=True))
+            print('   {}'.format(filename))
+        else:
+            print('   File {} not found.'.format(filename))
+            return None
+        if use_sketch:
+            if os.path.isfile(sketch.sketch_filename(filename)):
+                sketches.append(sketch.QuantileSketch.load(sketch.sketch_filename(filename)))
+            else:
+                print('   Sketch {} not found.'.format(sketch.sketch_filename(filename)))
+                return None
+    return experiments, sketches
+
+
+def plot(args, experiments, sketches):
+    '''
+        Writes one figure: a contour plot for one data file, or a violin plot
+        comparing several.
+
+        Accepts:
+            args            the parsed command line arguments of the figure
+            experiments     the Experiment of each data file
+            sketches        the QuantileSketch of each data file, if
+                            args.sketch is set
+
+        Returns the output filename, or None if nothing was written.
+    '''
+    filename = output_filename(args)
+    # if only one file, do a contour plot
+    if len(experiments) == 1:
+        print('Writing contour plot using {}'.format(args.rcfname))
+        e = experiments[0]
+        default_title='pop size={:,}   fitness={:.1f}   homogamy={:.1f}'\
+              ''.format(int(float(e.constant_pop_size)),
+                        float(e.aa_fitness),
+                        float(e.aa_homogamy))
+        rc = {'axes.titlesize': 10}
+        percentiles = None
+        density = None
+        if args.sketch:
+            X = sketches[0].quantile(0.5, 'gen')
+            Ya = sketches[0].sample(args.field)
+        else:
+            # summaries are cached next to the file, so repeat runs are quick
+            X = e.summary('gen', lambda: e.select('gen',0))
+            Ya = e.sorted_endpoint(args.field)
+            percentiles = e.percentiles(args.field, CONTOUR_PERCENTILES)
+            density = endpoint_density(e, args.field)
+        expected = expected_values(e, args.field) if args.expected else None
+        contour_plot(filename, X, Ya,
+                     title=args.title if args.title is not None else default_title,
+                     xlabel='Generation',
+                     ylabel=args.ylabel if args.ylabel is not None else AXIS_LABELS[args.field],
+                     ylim=args.ylim,
+                     yformat=args.yformat,
+                     rc=rc,
+                     rcfname=args.rcfname,
+                     percentiles=percentiles,
+                     density=density,
+                     expected=expected)
+        print('   {}'.format(filename))
+        return filename
+
+    # if more than one file, do a violin plot
+    print('Identifying independent variable(s)...')
+    indep_vars = []
+    for var in fileio.INDEP_VARS:
+        init_value = getattr(experiments[0],var)
+        for e in experiments:
+            if init_value != getattr(e, var):
+                indep_vars.append(var)
+                break
+    if len(indep_vars) == 0:
+        print('No independent variable identified.')
+        return None
+    elif len(indep_vars) > 1:
+        print('   {}'.format(indep_vars))
+        print('Code cannot handle this.')
+        return None
+    print('   {}'.format(indep_vars[0]))
+    categories = []
+    for e in experiments:
+        categories.append(getattr(e, indep_vars[0]))
+    print('Writing violin plot using {}'.format(args.rcfname))
+    default_title=''
+    violins = []
+    densities = None
+    if args.sketch:
+        for s in sketches:
+            violins.append(s.sample(args.field)[-1])
+    else:
+        densities = []
+        for e in experiments:
+            violins.append(e.sorted_endpoint(args.field))
+            densities.append(endpoint_density(e, args.field))
+    violin_plot (filename, violins,
+                 title=args.title if args.title is not None else default_title,
+                 xlabel=AXIS_LABELS[indep_vars[0]],
+                 categories=categories,
+                 ylabel=args.ylabel if args.ylabel is not None else AXIS_LABELS[args.field],
+                 ylim=args.ylim,
+                 yformat=args.yformat,
+                 yscale=args.yscale,
+                 rcfname=args.rcfname,
+                 densities=densities)
+    print('   {}'.format(filename))
+    return filename
+
+
+def _figure_key(args):
+    '''
+        Internal function which returns a digest of everything a figure
+        depends on: its arguments, and the size and modification time of
+        its data files, sketches and rc file.
+    '''
+    inputs = list(args.filenames) + [args.rcfname]
+    if args.sketch:
+        inputs += [sketch.sketch_filename(f) for f in args.filenames]
+    stamps = []
+    for f in inputs:
+        stat = os.stat(f) if os.path.isfile(f) else None
+        stamps.append(None if stat is None else [stat.st_size, stat.st_mtime_ns])
+    key = json.dumps([sorted(vars(args).items()), stamps])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _load(job):
+    '''
+        Worker function which opens one data file and computes the summaries
+        that its figures need, so that each file is read only once however
+        many figures use it.
+
+        Accepts:
+            job             a tuple of (filename, use_sketch, needs), where
+                            needs is a list of (field, contour) tuples
+    '''
+    filename, use_sketch, needs = job
+    files = read_files([filename], use_sketch)
+    if files is None:
+        return filename, use_sketch, None
+    e = files[0][0]
+    try:
+        for field, contour in needs:
+            if use_sketch:
+                continue
+            e.sorted_endpoint(field)
+            endpoint_density(e, field)
+            if contour:
+                e.summary('gen', lambda: e.select('gen',0))
+                e.percentiles(field, CONTOUR_PERCENTILES)
+    except Exception as error:
+        print('   {}: {}'.format(filename, error))
+        return filename, use_sketch, None
+    # only the small summaries go back to the main process; plot reads
+    # nothing else, and a binary file's memory-mapped cube would otherwise
+    # be copied whole
+    e.__dict__.pop('_cache', None)
+    e.__dict__.pop('_index', None)
+    e.cube = None
+    return filename, use_sketch, (e, files[1][0] if use_sketch else None)
+
+
+def _render(job):
+    '''
+        Worker function which writes one figure.
+
+        Accepts:
+            job             a tuple of (args, experiments, sketches)
+    '''
+    try:
+        return job[0], plot(*job)
+    except Exception as error:
+        print('   {}: {}'.format(output_filename(job[0]), error))
+        return job[0], None
+
+
+def batch(specname, parser):
+    '''
+        Writes every figure listed in a figure spec file. Each line of the
+        spec holds the grapher.py arguments of one figure; file names may be
+        glob patterns, and lines starting with # are comments. Every data
+        file is read once, and figures are drawn in parallel. A figure is
+        skipped if its output exists and neither its spec line nor any of
+        its inputs has changed since it was written.
+
+        Accepts:
+            specname        the figure spec file
+            parser          the grapher.py argument parser
+    '''
+    manifest_name = os.path.splitext(specname)[0] + '.manifest.json'
+    manifest = {}
+    if os.path.isfile(manifest_name):
+        with open(manifest_name) as f:
+            manifest = json.load(f)
+    figures = []
+    for line in open(specname):
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+        args = parser.parse_args(shlex.split(line))
+        args.filenames = [f for pattern in args.filenames
+                            for f in (sorted(glob.glob(pattern)) or [pattern])]
+        figures.append(args)
+    print('Read {} figure(s) from {}'.format(len(figures), specname))
+    todo = []
+    for args in figures:
+        key = _figure_key(args)
+        if os.path.isfile(output_filename(args)) and \
+           manifest.get(output_filename(args)) == key:
+            print('   {} is up to date.'.format(output_filename(args)))
+        else:
+            todo.append((args, key))
+    if len(todo) == 0:
+        return
+    needs = {}
+    for args, key in todo:
+        for filename in args.filenames:
+            needs.setdefault((filename, args.sketch), []).append(
+                (args.field, len(args.filenames) == 1))
+    pool = multiprocessing.Pool()
+    print('Reading {} file(s)...'.format(len(needs)))
+    files = {}
+    for filename, use_sketch, result in pool.imap_unordered(_load,
+                        [(f, use_sketch, n) for (f, use_sketch), n in needs.items()]):
+        files[(filename, use_sketch)] = result
+    jobs = []
+    keys = {}
+    for args, key in todo:
+        results = [files.get((f, args.sketch)) for f in args.filenames]
+        if any(r is None for r in results):
+            print('   Skipping {}'.format(output_filename(args)))
+            continue
+        jobs.append((args, [r[0] for r in results], [r[1] for r in results]))
+        keys[output_filename(args)] = key
+    print('Writing {} figure(s)...'.format(len(jobs)))
+    for args, filename in pool.imap_unordered(_render, jobs):
+        if filename is not None:
+            manifest[filename] = keys[filename]
+    pool.close()
+    with open(manifest_name, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
 #
 #   MAIN ROUTINE
 #
@@ -157,7 +539,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
                     formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('filenames',
-                        nargs = '+',
+                        nargs = '*',
                         help = 'filename(s) for data file')
     parser.add_argument('-o', '--output_file',
                         action='store',
@@ -192,89 +574,36 @@ if __name__ == '__main__':
                         action='store',
                         default = 'linear',
                         help = 'manual y axis formatter string')
+    parser.add_argument('--sketch',
+                        action='store_true',
+                        help = 'plot from the quantile sketch sidecar files ' \
+                               'instead of the data; quick, and works while ' \
+                               'simulator.py is still running')
+    parser.add_argument('--expected',
+                        action='store_true',
+                        help = 'overlay the values expected from Crow & ' \
+                               'Felsenstein (1968) on a contour plot of a ' \
+                               'or aa; they assume no selection')
+    parser.add_argument('--batch',
+                        action='store',
+                        default = None,
+                        metavar = 'SPEC',
+                        help = 'write every figure listed in a figure spec ' \
+                               'file, one line of grapher.py arguments per ' \
+                               'figure, skipping figures that are up to date')
     args=parser.parse_args()
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    experiments = []
-    print('Reading file(s)...')
-    for filename in args.filenames:
-        # Check to see if each individual file exists
-        if os.path.isfile(filename):
-            experiments.append(fileio.Experiment(filename))
-            print('   {}'.format(filename))
-        else:
-            print('   File {} not found.'.format(filename))
-            exit()
-
-    # if only one file, do a contour plot
-    if len(args.filenames) == 1:
-        print('Writing contour plot using {}'.format(args.rcfname))
-        e = experiments[0]
-        default_title='pop size={:,}   fitness={:.1f}   homogamy={:.1f}'\
-              ''.format(int(e.constant_pop_size),
-                        float(e.aa_fitness),
-                        float(e.aa_homogamy))
-        rc = {'axes.titlesize': 10}
-        X = e.select('gen',0)
-        if args.output_file:
-            filename = args.output_file
-        else:
-            filename = os.path.splitext(args.filenames[0])[0] + \
-                   '.contour_plot.{args.field}.{args.rcfname}.pdf'.format(**locals())
-        Ya = e.select(args.field)
-        contour_plot(filename, X, Ya,
-                     title=args.title if args.title is not None else default_title,
-                     xlabel='Generation',
-                     ylabel=args.ylabel if args.ylabel is not None else AXIS_LABELS[args.field],
-                     ylim=args.ylim,
-                     yformat=args.yformat,
-                     rc=rc,
-                     rcfname=args.rcfname)
-        print('   {}'.format(filename))
+    if args.batch is not None:
+        batch(args.batch, parser)
         print("Done.\n")
+        exit()
 
-    # if more than one file, do a violin plot
-    else:
-        print('Identifying independent variable(s)...')
-        indep_vars = []
-        for var in fileio.INDEP_VARS:
-            init_value = getattr(experiments[0],var)
-            for e in experiments:
-                if init_value != getattr(e, var):
-                    indep_vars.append(var)
-                    break
-        if len(indep_vars) == 0:
-            print('No independent variable identified. Exiting...')
-            exit()
-        elif len(indep_vars) > 1:
-            print('   {}'.format(indep_vars))
-            print('Code cannot handle this. Exiting...')
-            exit()
-        else:
-            print('   {}'.format(indep_vars[0]))
-            categories = []
-            for e in experiments:
-                categories.append(getattr(e, indep_vars[0]))
-            print('Writing violin plot using {}'.format(args.rcfname))
-            default_title=''
-            if args.output_file:
-                filename = args.output_file
-            else:
-                filename = os.path.splitext(args.filenames[0])[0] + \
-                    '.violin_plot.{args.field}.{args.rcfname}.pdf'.format(**locals())
-            violins = []
-            for e in experiments:
-                violins.append(e.select_endpoint(args.field))
-            violin_plot (filename, violins,
-                         title=args.title if args.title is not None else default_title,
-                         xlabel=AXIS_LABELS[indep_vars[0]],
-                         categories=categories,
-                         ylabel=args.ylabel if args.ylabel is not None else AXIS_LABELS[args.field],
-                         ylim=args.ylim,
-                         yformat=args.yformat,
-                         yscale=args.yscale,
-                         rcfname=args.rcfname)
-            print('   {}'.format(filename))
-        print("Done.\n")
+    print('Reading file(s)...')
+    files = read_files(args.filenames, args.sketch)
+    if files is None or len(args.filenames) == 0:
+        exit()
+    plot(args, *files)
+    print("Done.\n")
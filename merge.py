@@ -0,0 +1,65 @@
+#!/usr/local/bin/python3 -u
+# -*- coding: utf-8 -*-
+# We generally follow PEP 8: http://legacy.python.org/dev/peps/pep-0008/
+
+'''
+*Derek C. Braun, Brian H. Greenwald, Samir Jain, Eric Epstein, Brienna Herold, Maggie Gray
+(*derek.braun@gallaudet.edu)
+
+Merges the shard files written by simulator.py --shard i/N into one data file.
+If every shard has a quantile sketch sidecar, the sketches are merged too.
+'''
+
+import os
+import re
+import sys
+import argparse
+import fileio
+import sketch
+
+#
+#   MAIN ROUTINE
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filenames',
+                        nargs = '+',
+                        help = 'the shard files for one configuration')
+    parser.add_argument('-o', '--output_file',
+                        action = 'store',
+                        default = None,
+                        help = 'the merged filename (default: the shard ' \
+                               'filename without the _shard suffix)')
+    parser.add_argument('--overwrite',
+                        action = 'store_true',
+                        help = 'overwrite the merged file if it exists.')
+    args=parser.parse_args()
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    for filename in args.filenames:
+        if not os.path.isfile(filename):
+            print('File {} not found.'.format(filename))
+            exit()
+    if args.output_file:
+        filename = args.output_file
+    else:
+        filename = re.sub(r'_shard\d+of\d+\.tsv$', '.tsv', args.filenames[0])
+    print('Merging {} shard(s)...'.format(len(args.filenames)))
+    try:
+        e = fileio.merge(args.filenames, filename, overwrite=args.overwrite)
+    except ValueError as error:
+        print('   {}'.format(error))
+        exit()
+    print(e.metadata())
+    print('Saving file...\n   {}'.format(filename))
+    sidecars = [sketch.sketch_filename(f) for f in args.filenames]
+    if all(os.path.isfile(f) for f in sidecars):
+        s = sketch.QuantileSketch.load(sidecars[0])
+        for f in sidecars[1:]:
+            s.merge(sketch.QuantileSketch.load(f))
+        s.save(sketch.sketch_filename(filename))
+        print('Saving sketch...\n   {}'.format(sketch.sketch_filename(filename)))
+    print('Done.')
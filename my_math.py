@@ -18,6 +18,45 @@ GENERATIONS         = 20       # Nance and Kearsey: 5 gen with 0 fitness + 20 ge
 
 import os
 import argparse
+import numpy
+
+
+def crowFelsenstein(homogamy=aa_HOMOGAMY, a=a_FREQ, deaf=DEAF_FREQ,
+                    generations=GENERATIONS):
+    '''
+        Evaluates the Crow & Felsenstein (1968) recursion for deaf-deaf
+        assortative mating, without selection, over whole parameter grids.
+        The arguments may be numbers or arrays, and are broadcast together,
+        e.g. homogamy[:,None] and a[None,:] give a homogamy x a grid.
+
+        Accepts:
+            homogamy        deaf-deaf assortative mating (homogamy)
+            a               the frequency of the recessive allele
+            deaf            the frequency of deaf individuals, from all
+                            causes
+            generations     the number of generations
+
+        Returns a tuple of two float arrays, r (the correlation between
+        mates) and aa (the frequency of aa individuals), each of shape
+        (broadcast shape, max(generations)). Generations past an element's
+        own number of generations are nan.
+    '''
+    homogamy, q, deaf, generations = numpy.broadcast_arrays(
+        *[numpy.asarray(x, dtype=float) for x in (homogamy, a, deaf, generations)])
+    p = 1-q
+    Rt = q**2
+    steps = int(generations.max()) if generations.size > 0 else 0
+    r = numpy.empty(homogamy.shape + (steps,))
+    aa = numpy.empty(homogamy.shape + (steps,))
+    for gen in range(steps):
+        r[...,gen] = homogamy * Rt/(deaf-q**2+Rt)  # recalculate r after each gen for more accuracy
+        Rt = (1-r[...,gen])*q**2 + r[...,gen]*(q**2+Rt*(p-q))/(1-Rt)  # equation 3 from Crow & Felsenstein (1968);
+        aa[...,gen] = Rt
+    done = numpy.arange(steps) >= generations[...,None]
+    r[done] = numpy.nan
+    aa[done] = numpy.nan
+    return r, aa
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
@@ -30,17 +69,10 @@ if __name__ == '__main__':
                                '(default {}).'.format(aa_HOMOGAMY))
     args=parser.parse_args()
 
-    headers = ['gen', 'aa']
-    rows = []
-
-    q = a_FREQ
-    p = 1-q
-    Rt = q**2
+    r, aa = crowFelsenstein(args.homogamy)
     print('{:^7}   {:^7}   {:^7}'.format('gen', 'r', 'aa'))
     print('{:^7}   {:^7}   {:^7}'.format('-'*7, '-'*7, '-'*7))
     for gen in range(GENERATIONS):
-        r = args.homogamy * Rt/(DEAF_FREQ-q**2+Rt)  # recalculate r after each gen for more accuracy
-        Rt = (1-r)*q**2 + r*(q**2+Rt*(p-q))/(1-Rt)  # equation 3 from Crow & Felsenstein (1968);
-        print('{:^7}   {:^7.3%}   {:^7.4%}'.format(gen, r, Rt))
+        print('{:^7}   {:^7.3%}   {:^7.4%}'.format(gen, r[gen], aa[gen]))
     print('Done.')
     exit()
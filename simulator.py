@@ -24,18 +24,121 @@ aa_HOMOGAMY         = 0.9      # Nance and Kearsey: 0.9
 DEAF_FREQ           = 0.0008   # Nance and Kearsey: two other genes each at 0.003^2 freq (tiny)
 GENERATIONS         = 20       # Nance and Kearsey: 5 gen with 0 fitness + 20 gen with 1.0 fitness
 SIMULATIONS         = 5000
+ADAPTIVE_MIN        = 500      # the fewest simulations in adaptive mode
+ADAPTIVE_CHUNK      = 250      # simulations per configuration per adaptive round
+ADAPTIVE_QUANTILES  = [0.02, 0.5, 0.98]
+
+# the fields recorded for each generation, in the order they are written
+FIELDS = ['gen', 'A', 'a', 'AA', 'Aa', 'aa', 'deaf', 'AA_size', 'Aa_size',
+          'aa_size', 'deaf_size', 'homogamy', 'F']
 
 
 import os
+import re
 import time
+import hashlib
 import random
 import argparse
+import queue
+import threading
+import itertools
 import subprocess
 import multiprocessing
+import numpy
 import simuOpt
 simuOpt.setOptions(optimized=True, numThreads=0, quiet=True)
 import simuPOP as sim
 import fileio
+import sketch
+
+
+def configuration_key(e):
+    '''
+        Returns a stable 32-bit key for the configuration of an Experiment,
+        hashed from its fileio.INDEP_VARS. Numbers are hashed as floats, so
+        e.g. 0.9 given on the command line and '0.9' read from a file give
+        the same key.
+    '''
+    values = []
+    for var in fileio.INDEP_VARS:
+        value = getattr(e, var, None)
+        try:
+            values.append(repr(float(value)))
+        except (TypeError, ValueError):
+            values.append(str(value))
+    digest = hashlib.sha1('\t'.join(values).encode()).digest()
+    return int.from_bytes(digest[:4], 'little')
+
+
+def replicate_seed(seed, replicate, replicates=None, configuration=None):
+    '''
+        Derives the seed sequence for one replicate (or for a block of
+        replicates starting at replicate) from the master seed. Replicates
+        are children of the master seed in a numpy.random.SeedSequence tree,
+        so every replicate has an independent, reproducible stream no matter
+        which process or machine runs it.
+
+        Accepts:
+        seed            the master seed (an int), or None for fresh entropy
+        replicate       the replicate index
+        replicates      for a block of replicates, the size of the block
+        configuration   an optional configuration_key. The configurations of
+                        a sweep share the master seed, so their replicates
+                        are only independent if each has its own key.
+
+        Returns a numpy.random.SeedSequence.
+    '''
+    if seed is None:
+        return numpy.random.SeedSequence()
+    key = (replicate,) if replicates is None else (replicate, replicates)
+    if configuration is not None:
+        key = (configuration,) + key
+    return numpy.random.SeedSequence(int(seed), spawn_key=key)
+
+
+def shard_range(shard, simulations):
+    '''
+        Returns the range of replicate indices run by a shard. Shards are
+        contiguous, so merging shard files in order keeps replicate order.
+
+        Accepts:
+        shard           a string 'i/N' (1 <= i <= N), or None for all
+        simulations     the total number of replicates
+    '''
+    if shard is None:
+        return range(simulations)
+    i, n = [int(x) for x in shard.split('/')]
+    return range((i-1)*simulations//n, i*simulations//n)
+
+
+def _choose_couples(parent1s, parent2s, weights, size):
+    '''
+        Generator which draws parents from a weighted couple table. Couples
+        are stored as parallel index arrays with integer weights (the number
+        of entries each couple would have in a list of parental pairs), and
+        are drawn in blocks of size using a search over the cumulative
+        weights.
+
+        Accepts:
+        parent1s, parent2s      arrays of individual indices
+        weights                 array of integer weights
+        size                    number of parents to draw per block
+
+        Yields:
+        (parent1, parent2) tuple of two individual indices
+    '''
+    parent1s = numpy.asarray(parent1s, dtype=numpy.int64)
+    parent2s = numpy.asarray(parent2s, dtype=numpy.int64)
+    cumulative = numpy.cumsum(weights)
+    if len(cumulative) == 0 or cumulative[-1] == 0:
+        raise IndexError('No couples are available to choose parents from.')
+    while True:
+        draws = numpy.searchsorted(cumulative,
+                                   numpy.random.randint(cumulative[-1], size=size),
+                                   side='right')
+        for parent1, parent2 in zip(parent1s[draws].tolist(),
+                                    parent2s[draws].tolist()):
+            yield parent1, parent2
 
 
 def customChooser(pop, subPop):
@@ -63,45 +166,48 @@ def customChooser(pop, subPop):
         pop, subpop (this is standard/required by simuPOP)
 
         Yields:
-        (parent1, parent2) tuple of two individuals (standard/required by simuPOP)
+        (parent1, parent2) tuple of two individual indices (standard/required
+        by simuPOP)
     '''
 
     def mate_with_fitness(parent1, parent2):
         '''
-            Mates a couple and creates offspring. Creates a number of entries in the
-            final list (representing the parents for each child to be born), based on
+            Mates a couple and adds it to the couple table, with a weight
+            representing the number of children to be born, based on
             reproductive fitness. Non-integer number of children are handled by
             using a randomizer for the fractional amount.
 
             Accepts:
-            parent1, parent2             sim.individual objects
-
-            Returns a list of (parent1, parent2) parental pairs
-            reflecting fitness.
+            parent1, parent2             individual indices
         '''
-
-        if parent1.genotype() == [1,1] or parent2.genotype() == [1,1]:
+        parent1s.append(parent1)
+        parent2s.append(parent2)
+        if aa[parent1] or aa[parent2]:
             r = float(pop.dvars().aa_fitness)
-            l = []
+            w = 0
             while r >= 1:
-                l += [(parent1, parent2)]
+                w += 1
                 r -= 1
             if random.random() < r:
-                l += [(parent1, parent2)]
-            return l
+                w += 1
+            weights.append(w)
         else:
-            return [(parent1, parent2)]
+            weights.append(1)
 
     deaf_parents = []
     hearing_parents = []
-    couples = []
+    aa = []
+    parent1s = []
+    parent2s = []
+    weights = []
 
     # bin individuals
-    for person in pop.individuals():
-        if person.genotype() == [1,1]:
-            deaf_parents.append(person)
+    for i, person in enumerate(pop.individuals()):
+        aa.append(person.genotype() == [1,1])
+        if aa[i]:
+            deaf_parents.append(i)
         else:
-            hearing_parents.append(person)
+            hearing_parents.append(i)
 
     # move some "hearing" individuals into the deaf bin - making them deaf -
     # to reflect non-Cx26 causes of congenital deafness. These individuals will
@@ -118,7 +224,7 @@ def customChooser(pop, subPop):
     target = int(round(pop.dvars().aa_homogamy * len(deaf_parents)/2))
     for i in range(target):
         if len(deaf_parents) >= 2:
-            couples += mate_with_fitness(deaf_parents.pop(), deaf_parents.pop())
+            mate_with_fitness(deaf_parents.pop(), deaf_parents.pop())
         else:
             break
     if dp > 0:
@@ -131,19 +237,196 @@ def customChooser(pop, subPop):
     remaining_parents = hearing_parents + deaf_parents
     random.shuffle(remaining_parents)
     while len(remaining_parents) > 2:
-        couples += mate_with_fitness(remaining_parents.pop(), remaining_parents.pop())
+        mate_with_fitness(remaining_parents.pop(), remaining_parents.pop())
 
     # This is what's called whenever the generator function is called.
-    while True:
-        yield random.choice(couples)
+    yield from _choose_couples(parent1s, parent2s, weights, pop.popSize())
 
 
-def simuAssortativeMatingWithFitness(e):
+def numpyChooser(pop, subPop):
     '''
+        Vectorized equivalent of customChooser.
+
+        Follows the same mating scheme as customChooser, but the genotypes
+        are pulled out of the population once as a numpy array, and the
+        binning, pairing and fitness steps are done with array operations on
+        individual indices instead of lists of sim.individual objects.
+
+        Uses:  (there is no way to pass variables to numpyChooser)
+        pop.dvars().aa_fitness
+        pop.dvars().aa_homogamy
+        pop.dvars().adv_deaf_target
+
         Accepts:
-        e               an Experiment object.
+        pop, subpop (this is standard/required by simuPOP)
+
+        Yields:
+        (parent1, parent2) tuple of two individual indices (standard/required
+        by simuPOP)
+    '''
+    size = pop.popSize()
+    genotypes = numpy.array(pop.genotype(), dtype=numpy.int8).reshape(size, 2)
+    aa = genotypes.sum(axis=1) == 2
+
+    # bin individuals
+    deaf_parents = numpy.flatnonzero(aa)
+    hearing_parents = numpy.flatnonzero(~aa)
+
+    # move some "hearing" individuals into the deaf bin, taking them from the
+    # end of the hearing bin just like customChooser does
+    adv_deaf = min(max(pop.dvars().adv_deaf_target, 0), len(hearing_parents))
+    split = len(hearing_parents) - adv_deaf
+    deaf_parents = numpy.random.permutation(
+                        numpy.concatenate((deaf_parents, hearing_parents[split:])))
+    hearing_parents = hearing_parents[:split]
+
+    # calculate how many deaf-deaf marriages we need, then marry them off
+    dp = float(len(deaf_parents))
+    target = int(round(pop.dvars().aa_homogamy * len(deaf_parents)/2))
+    n = min(target, len(deaf_parents)//2)
+    if dp > 0:
+        pop.dvars().homogamy = 2*target/dp
+    else:
+        pop.dvars().homogamy = -1
+
+    # Merge remaining parents and mate them off. As in customChooser, the
+    # last two remaining parents are not mated.
+    remaining_parents = numpy.random.permutation(
+                        numpy.concatenate((hearing_parents, deaf_parents[2*n:])))
+    m = max(len(remaining_parents) - 1, 0)//2
+    couples = numpy.concatenate((deaf_parents[:2*n].reshape(n, 2),
+                                 remaining_parents[:2*m].reshape(m, 2)))
 
-        Returns a dict containing the results from each gen of the simulation:
+    # each couple with a deaf (aa) parent gets a weight of floor(aa_fitness),
+    # plus one with probability equal to the fractional part
+    r = float(pop.dvars().aa_fitness)
+    fit = aa[couples].any(axis=1)
+    weights = numpy.ones(len(couples), dtype=numpy.int64)
+    weights[fit] = int(r) + (numpy.random.random(fit.sum()) < r - int(r))
+
+    # This is what's called whenever the generator function is called.
+    yield from _choose_couples(couples[:,0], couples[:,1], weights, size)
+
+
+# parent choosers that can be selected with --engine
+CHOOSERS = {'python' : customChooser,
+            'numpy'  : numpyChooser}
+
+class StatsCollector:
+    '''
+        Python operator which collects the FIELDS for each generation into
+        a preallocated float array of shape (generations, len(FIELDS)). It
+        should follow sim.Stat(alleleFreq=[0], genoFreq=[0]) in postOps.
+    '''
+    def __init__(self, generations):
+        self.headers = FIELDS
+        self.data = numpy.zeros((generations, len(FIELDS)))
+        self.gen = 0
+
+    def reset(self):
+        '''
+            Prepares the collector for another replicate, reusing its array.
+        '''
+        self.data[:] = 0.
+        self.gen = 0
+
+    def __call__(self, pop):
+        '''
+            Records the current generation. Called by sim.PyOperator.
+
+            Returns True, so that evolution continues.
+        '''
+        v = pop.dvars()
+        size = pop.popSize()
+        A = v.alleleFreq[0][0]
+        a = v.alleleFreq[0][1]
+        Aa = v.genoFreq[0][(0,1)] + v.genoFreq[0][(1,0)]
+        F = 1.0 - Aa/(2.0*A*a) if A*a > 0. else 0.
+        deaf_size = min(v.genoNum[0][(1,1)] + v.adv_deaf_target, size)
+        self.data[self.gen] = (self.gen,
+                            A,
+                            a,
+                            v.genoFreq[0][(0,0)],
+                            Aa,
+                            v.genoFreq[0][(1,1)],
+                            deaf_size/float(size),
+                            v.genoNum[0][(0,0)],
+                            v.genoNum[0][(0,1)] + v.genoNum[0][(1,0)],
+                            v.genoNum[0][(1,1)],
+                            deaf_size,
+                            v.homogamy,
+                            F if F > 0. else 0.)
+        self.gen += 1
+        return True
+
+
+class Simulation:
+    '''
+        Holds a simuPOP population and its evolve configuration for one
+        Experiment. They are built once, and every call to run only
+        reinitializes the genotypes and state, so a worker process can reuse
+        them for all of its replicates.
+    '''
+    def __init__(self, e):
+        '''
+            Accepts:
+            e               an Experiment object. e.engine selects the parent
+                            chooser from CHOOSERS (default 'python').
+        '''
+        self.e = e
+        self.pop = sim.Population(e.constant_pop_size*1000, loci=[1])
+        # These variables need to be set in order to be available to customChooser().
+        # There appears to be no way to directly pass variables to customChooser().
+        self.pop.dvars().constant_pop_size   = e.constant_pop_size
+        self.pop.dvars().a                   = e.a
+        self.pop.dvars().aa_fitness          = e.aa_fitness
+        self.pop.dvars().aa_homogamy         = e.aa_homogamy
+        self.pop.dvars().deaf                = e.deaf
+        self.pop.dvars().adv_deaf_target     = int(round((e.deaf - e.a**2) * e.constant_pop_size * 1000))
+
+        self.collector = StatsCollector(e.generations)
+        self.matingScheme = sim.HomoMating(
+                    chooser = sim.PyParentsChooser(CHOOSERS[e.engine or 'python']),
+                    generator = sim.OffspringGenerator(sim.MendelianGenoTransmitter()))
+        self.postOps = [sim.Stat(alleleFreq=[0], genoFreq=[0]),
+                        sim.PyOperator(func=self.collector)]
+
+    def run(self, seed=None):
+        '''
+            Runs one replicate.
+
+            Accepts:
+            seed            an optional numpy.random.SeedSequence which seeds
+                            simuPOP, random and numpy.random for this replicate.
+
+            Returns the same dict as simuAssortativeMatingWithFitness.
+        '''
+        if seed is None:
+            seed = numpy.random.SeedSequence()
+        state = seed.generate_state(3)
+        sim.setRNG(seed=int(state[0]))
+        random.seed(int(state[1]))
+        numpy.random.seed(int(state[2]))
+        self.collector.reset()
+        sim.initGenotype(self.pop, freq=[1-self.e.a, self.e.a])
+        self.pop.evolve(
+            matingScheme = self.matingScheme,
+            postOps = self.postOps,
+            gen = self.e.generations
+        )
+        return {'headers':self.collector.headers, 'data':self.collector.data.copy()}
+
+
+def simuAssortativeMatingWithFitness(e, seed=None):
+    '''
+        Accepts:
+        e               an Experiment object. e.engine selects the parent
+                        chooser from CHOOSERS (default 'python').
+        seed            an optional numpy.random.SeedSequence which seeds
+                        simuPOP, random and numpy.random for this replicate.
+
+        Returns a dict with the FIELDS as 'headers' and a float array of
+        shape (generations, len(FIELDS)) as 'data'. The fields are:
         gen             generation number.
         A               frequency of the A allele.
         a               frequency of the a allele.
@@ -160,51 +443,410 @@ def simuAssortativeMatingWithFitness(e):
 
         Adopted from: http://simupop.sourceforge.net/Cookbook/AssortativeMating
     '''
-    sim.setRNG(random.seed(sim.getRNG().seed()))
-    pop = sim.Population(e.constant_pop_size*1000, loci=[1])
-    # These variables need to be set in order to be available to customChooser().
-    # There appears to be no way to directly pass variables to customChooser().
-    pop.dvars().constant_pop_size   = e.constant_pop_size
-    pop.dvars().a                   = e.a
-    pop.dvars().aa_fitness          = e.aa_fitness
-    pop.dvars().aa_homogamy         = e.aa_homogamy
-    pop.dvars().deaf                = e.deaf
-    pop.dvars().adv_deaf_target     = int(round((e.deaf - e.a**2) * e.constant_pop_size * 1000))
-
-    # These will hold the final data
-    pop.dvars().headers             = []
-    pop.dvars().row                 = []
-    pop.evolve(
-        initOps= [sim.InitGenotype(freq=[1-e.a, e.a])],
-        matingScheme = sim.HomoMating(
-                    chooser = sim.PyParentsChooser(customChooser),
-                    generator = sim.OffspringGenerator(sim.MendelianGenoTransmitter())),
-        postOps = [sim.Stat(alleleFreq=[0], genoFreq=[0]),
-                   sim.PyExec(r"headers += ['gen','A', 'a',"\
-                               "'AA', 'Aa', 'aa', 'deaf', 'AA_size', 'Aa_size', " \
-                               "'aa_size',  'deaf_size', 'homogamy', 'F'] \n" \
-                               "F = 1.0-((genoFreq[0][(0,1)]+genoFreq[0][(1,0)])/" # F          \
-                               "(2.0*alleleFreq[0][0]*alleleFreq[0][1])) "\
-                               "if alleleFreq[0][0]*alleleFreq[0][1] > 0. "\
-                               "else 0. \n" \
-                               "deaf_size = min(genoNum[0][(1,1)] + adv_deaf_target, constant_pop_size*1000) \n"\
-                               "row += [gen, "                           # generation \
-                               "alleleFreq[0][0], "                      # A          \
-                               "alleleFreq[0][1], "                      # a          \
-                               "genoFreq[0][(0,0)],"                     # AA         \
-                               "genoFreq[0][(0,1)]+genoFreq[0][(1,0)], " # Aa         \
-                               "genoFreq[0][(1,1)], "                    # aa         \
-                               "deaf_size/(constant_pop_size*1000.), "   # deaf       \
-                               "genoNum[0][(0,0)], "                     # AA_size    \
-                               "genoNum[0][(0,1)]+genoNum[0][(1,0)], "   # Aa_size    \
-                               "genoNum[0][(1,1)], "                     # aa_size    \
-                               "deaf_size, "                             # deaf_size  \
-                               "homogamy, "                              # homogamy   \
-                               "F if F>0. else 0.]")                     # F          \
-                   ],
-        gen = e.generations
-    )
-    return {'headers':pop.dvars().headers, 'row':pop.dvars().row}
+    return Simulation(e).run(seed)
+
+
+def _hypergeometric(rng, colors, nsample):
+    '''
+        Multivariate hypergeometric draw over the three genotypes, built from
+        univariate draws so that it broadcasts over leading axes.
+
+        Accepts:
+        rng             a numpy.random.Generator
+        colors          (..., 3) array of AA, Aa, aa counts in the urn
+        nsample         number of individuals drawn without replacement
+
+        Returns a (..., 3) array of AA, Aa, aa counts drawn.
+    '''
+    AA = rng.hypergeometric(colors[...,0], colors[...,1] + colors[...,2], nsample)
+    Aa = rng.hypergeometric(colors[...,1], colors[...,2], nsample - AA)
+    return numpy.stack((AA, Aa, nsample - AA - Aa), axis=-1)
+
+
+def _pair(rng, counts, n):
+    '''
+        Randomly pairs off 2n individuals drawn from counts, as shuffling a
+        list of individuals and popping two at a time would.
+
+        Accepts:
+        rng             a numpy.random.Generator
+        counts          (..., 3) array of AA, Aa, aa counts to draw from
+        n               number of couples to form
+
+        Returns a tuple of
+        couples         (..., 3, 3) array counting couples by the genotypes
+                        of parent1 and parent2
+        left            (..., 3) array of the individuals left unpaired
+    '''
+    paired = _hypergeometric(rng, counts, 2*n)
+    first = _hypergeometric(rng, paired, n)
+    second = paired - first
+    couples = []
+    for g in range(3):
+        row = _hypergeometric(rng, second, first[...,g])
+        second = second - row
+        couples.append(row)
+    return numpy.stack(couples, axis=-2), counts - paired
+
+
+def _aggregate_generation(rng, counts, e):
+    '''
+        Advances genotype counts by one generation, applying the same binning,
+        assortative pairing, fitness and Mendelian transmission steps as
+        customChooser and sim.MendelianGenoTransmitter.
+
+        Accepts:
+        rng             a numpy.random.Generator
+        counts          (..., 3) array of AA, Aa, aa counts
+        e               an Experiment object
+
+        Returns a tuple of
+        counts          (..., 3) array of AA, Aa, aa counts of the offspring
+        homogamy        (...) array of the calculated actual homogamy
+    '''
+    size = counts.sum(axis=-1)
+    adv_deaf_target = int(round((e.deaf - e.a**2) * e.constant_pop_size * 1000))
+
+    # bin individuals, moving some hearing individuals into the deaf bin
+    hearing = counts.copy()
+    hearing[...,2] = 0
+    adv_deaf = numpy.minimum(max(adv_deaf_target, 0), hearing.sum(axis=-1))
+    moved = _hypergeometric(rng, hearing, adv_deaf)
+    deaf = counts - hearing + moved
+    hearing = hearing - moved
+
+    # deaf-deaf marriages
+    dp = deaf.sum(axis=-1)
+    target = numpy.round(e.aa_homogamy * dp/2).astype(numpy.int64)
+    homogamy = numpy.where(dp > 0, 2*target/numpy.maximum(dp, 1), -1.)
+    deaf_couples, deaf = _pair(rng, deaf, numpy.minimum(target, dp//2))
+
+    # the remaining parents; the last two are not mated
+    remaining = hearing + deaf
+    m = numpy.maximum(remaining.sum(axis=-1) - 1, 0)//2
+    couples, remaining = _pair(rng, remaining, m)
+    couples = couples + deaf_couples
+
+    # couples with a deaf (aa) parent get floor(aa_fitness) entries, plus one
+    # more entry with probability equal to the fractional part
+    r = float(e.aa_fitness)
+    fit = numpy.zeros((3, 3), dtype=bool)
+    fit[2,:] = fit[:,2] = True
+    weights = numpy.where(fit, couples*int(r) + rng.binomial(couples, r - int(r)),
+                          couples)
+    total = weights.sum(axis=(-2, -1))
+    if numpy.any(total == 0):
+        raise ValueError('No couples are available to choose parents from.')
+
+    # Mendelian transmission: each parent passes on a with probability 0, 1/2
+    # or 1 for AA, Aa and aa.
+    t = numpy.array([0., 0.5, 1.])
+    t1, t2 = t[:,None], t[None,:]
+    transmission = numpy.stack(((1-t1)*(1-t2),
+                                t1*(1-t2) + (1-t1)*t2,
+                                t1*t2), axis=-1)
+    p = numpy.einsum('...ij,ijg->...g', weights, transmission)
+    p = p/total[...,None]
+    return rng.multinomial(size, p), homogamy
+
+
+def _aggregate_stats(gen, counts, homogamy, e):
+    '''
+        Calculates the FIELDS recorded for one generation from genotype
+        counts, matching the values computed by the sim.Stat postOps in
+        simuAssortativeMatingWithFitness.
+
+        Accepts:
+        gen             generation number
+        counts          (..., 3) array of AA, Aa, aa counts
+        homogamy        (...) array of the calculated actual homogamy
+        e               an Experiment object
+
+        Returns a (..., len(FIELDS)) float array.
+    '''
+    size = float(int(round(e.constant_pop_size * 1000)))
+    adv_deaf_target = int(round((e.deaf - e.a**2) * e.constant_pop_size * 1000))
+    AA_size, Aa_size, aa_size = [counts[...,g].astype(float) for g in range(3)]
+    A = (2.*AA_size + Aa_size)/(2.*size)
+    a = 1. - A
+    Aa = Aa_size/size
+    F = numpy.where(A*a > 0., 1.0 - Aa/(2.0*numpy.maximum(A*a, 1e-300)), 0.)
+    deaf_size = numpy.minimum(aa_size + adv_deaf_target, size)
+    return numpy.stack(numpy.broadcast_arrays(
+                          gen,
+                          A,
+                          a,
+                          AA_size/size,
+                          Aa,
+                          aa_size/size,
+                          deaf_size/size,
+                          AA_size,
+                          Aa_size,
+                          aa_size,
+                          deaf_size,
+                          homogamy,
+                          numpy.maximum(F, 0.)), axis=-1)
+
+
+def batchAssortativeMatingWithFitness(e, replicates, seed=None):
+    '''
+        Runs a block of replicates of the genotype-count engine together.
+        Every array carries a leading replicate axis, so each generation
+        costs a fixed number of array operations for the whole block.
+
+        Accepts:
+        e               an Experiment object.
+        replicates      the number of replicates in the block.
+        seed            an optional numpy.random.SeedSequence for the block
+
+        Returns a float array of shape (replicates, generations, len(FIELDS))
+        that can be passed directly to Experiment.write.
+    '''
+    rng = numpy.random.default_rng(seed)
+    size = int(round(e.constant_pop_size * 1000))
+    counts = rng.multinomial(size, [(1-e.a)**2, 2*e.a*(1-e.a), e.a**2],
+                             size=replicates)
+    block = numpy.empty((replicates, e.generations, len(FIELDS)))
+    for gen in range(e.generations):
+        counts, homogamy = _aggregate_generation(rng, counts, e)
+        block[:,gen,:] = _aggregate_stats(gen, counts, homogamy, e)
+    return block
+
+
+def batch_blocks(e, replicates, batch, cache=None):
+    '''
+        Generator which runs a contiguous range of replicates with
+        batchAssortativeMatingWithFitness. Blocks are aligned to multiples
+        of batch: the block starting at replicate b*batch is seeded from the
+        master seed, the configuration_key, b*batch and batch, and is always
+        run whole, then trimmed to the range. So the data of every replicate
+        depend only on the master seed, its configuration, its index and
+        batch, however a run is resumed, sharded or split into rounds.
+
+        Accepts:
+        e               an Experiment object. Its seed is the master seed.
+        replicates      a range of replicate indices
+        batch           the number of replicates in a block
+        cache           an optional dict which holds the last block run, so
+                        that a later call can continue a block in part
+
+        Yields:
+        float arrays of shape (replicates, generations, len(FIELDS)), in
+        replicate order
+    '''
+    if len(replicates) == 0:
+        return
+    start, stop = replicates[0], replicates[-1] + 1
+    for first in range(start - start % batch, stop, batch):
+        if cache is not None and cache.get('first') == first:
+            block = cache['block']
+        else:
+            block = batchAssortativeMatingWithFitness(e, batch,
+                                        replicate_seed(e.seed, first, batch,
+                                                       configuration_key(e)))
+            if cache is not None:
+                cache.update(first=first, block=block)
+        yield block[max(start, first) - first:min(stop, first + batch) - first]
+
+
+def aggregateAssortativeMatingWithFitness(e, seed=None):
+    '''
+        Genotype-count engine. Since the model has a single locus, every field
+        recorded by simuAssortativeMatingWithFitness depends only on the AA,
+        Aa and aa counts. This engine tracks only those counts, using
+        hypergeometric and multinomial draws for each step, so the cost of
+        a generation does not depend on the population size.
+
+        Accepts:
+        e               an Experiment object.
+        seed            an optional numpy.random.SeedSequence
+
+        Returns a dict with the same headers and data as
+        simuAssortativeMatingWithFitness.
+    '''
+    block = batchAssortativeMatingWithFitness(e, 1, seed)
+    return {'headers':FIELDS, 'data':block[0]}
+
+
+def simulate(e, replicate=0, simulation=None):
+    '''
+        Runs one simulation using the engine selected by e.engine.
+
+        Accepts:
+        e               an Experiment object. Its seed is the master seed.
+        replicate       the replicate index, from which the replicate's
+                        seed is derived.
+        simulation      an optional Simulation for e to be reused.
+
+        Returns a dict with headers and data, as simuAssortativeMatingWithFitness.
+    '''
+    seed = replicate_seed(e.seed, replicate, configuration=configuration_key(e))
+    if e.engine == 'aggregate':
+        return aggregateAssortativeMatingWithFitness(e, seed)
+    elif simulation is not None:
+        return simulation.run(seed)
+    else:
+        return simuAssortativeMatingWithFitness(e, seed)
+
+
+# Set in each pool worker process by _init_worker. Simulations are built the
+# first time a worker runs each configuration, then reused. Tasks arrive in
+# configuration order, so each worker keeps only the WORKER_SIMULATIONS
+# configurations it ran last, in least recently used order; a whole
+# population for every configuration of a sweep would not fit in memory.
+WORKER_SIMULATIONS = 2
+_experiments = []
+_simulations = {}
+
+
+def _init_worker(experiments):
+    '''
+        Pool initializer. Keeps the experiments in the worker process, so
+        that tasks only need to pass indices. It does not rely on fork, so
+        it also works with the spawn start method.
+    '''
+    global _experiments
+    _experiments = experiments
+    _simulations.clear()
+
+
+def _task(task):
+    '''
+        Runs one (configuration, replicate) task for Pool.imap_unordered.
+
+        Accepts:
+        task            a tuple of (configuration index, replicate)
+
+        Returns a tuple of (configuration index, replicate, data).
+    '''
+    i, replicate = task
+    e = _experiments[i]
+    simulation = None
+    if e.engine != 'aggregate':
+        if i in _simulations:
+            simulation = _simulations.pop(i)
+        else:
+            while len(_simulations) >= WORKER_SIMULATIONS:
+                del _simulations[next(iter(_simulations))]
+            simulation = Simulation(e)
+        # the most recently used configuration goes last
+        _simulations[i] = simulation
+    return i, replicate, simulate(e, replicate, simulation)['data']
+
+
+def _open_sketch(experiment, rows):
+    '''
+        Returns the quantile sketch for an experiment's file. A new file gets
+        an empty sketch. A resumed file keeps its sidecar if it covers every
+        row in the file; otherwise the sketch is rebuilt from the file.
+
+        Accepts:
+        experiment      an Experiment object with filename and headers set
+        rows            the number of rows already in the file
+    '''
+    filename = sketch.sketch_filename(experiment.filename)
+    if rows > 0 and os.path.isfile(filename):
+        s = sketch.QuantileSketch.load(filename, seed=experiment.seed)
+        if s.count == rows and s.headers == experiment.headers:
+            return s
+    s = sketch.QuantileSketch(experiment.headers, seed=experiment.seed)
+    if rows > 0:
+        print('Rebuilding sketch...\n   {}'.format(filename))
+        s.update(fileio.Experiment(experiment.filename).array())
+    s.save(filename)
+    return s
+
+
+def _ci_width(s, fields):
+    '''
+        Returns the width of the widest 95% confidence interval among the
+        endpoint ADAPTIVE_QUANTILES of fields, estimated from a sketch.
+
+        Accepts:
+        s               a QuantileSketch of an experiment's data
+        fields          a list of fields
+    '''
+    widths = []
+    for field in fields:
+        for q in ADAPTIVE_QUANTILES:
+            low, high = s.interval(q, field)
+            widths.append(high[-1] - low[-1])
+    return max(widths)
+
+
+def _writer(results, experiments, todo, sketches, errors, interval=60.,
+            report=True):
+    '''
+        Writer thread. Takes (configuration index, replicate, data) results
+        from a queue in any order, and appends them to each experiment's file
+        in replicate order, so that resumed and sharded files stay in order.
+        Rows are batched, and written at most once per interval seconds or
+        when a file is complete. Each file is opened once. A None on the
+        queue flushes everything and ends the thread.
+
+        Accepts:
+        results         a queue.Queue
+        experiments     a list of Experiment objects
+        todo            a list with the replicate indices for each experiment
+        sketches        a list with the QuantileSketch for each experiment,
+                        which is updated and saved after each write
+        errors          a list. If writing fails, the exception is appended
+                        to it, for the main thread to re-raise, and the
+                        thread ends.
+        interval        the time between writes, in seconds
+        report          whether to print each file once its todo is written.
+                        In adaptive rounds it is False, since a file is
+                        only finished when its CIs are narrow enough.
+    '''
+    files = []
+    try:
+        files = [open(e.filename, 'a') for e in experiments]
+        waiting = [{} for e in experiments]
+        ready = [[] for e in experiments]
+        position = [0] * len(experiments)
+        last_write = time.time()
+        while True:
+            result = results.get()
+            complete = False
+            if result is not None:
+                i, replicate, data = result
+                waiting[i][replicate] = data
+                while position[i] < len(todo[i]) and todo[i][position[i]] in waiting[i]:
+                    ready[i].append(waiting[i].pop(todo[i][position[i]]))
+                    position[i] += 1
+                complete = position[i] == len(todo[i])
+            if result is None or complete or time.time() - last_write > interval:
+                for j, e in enumerate(experiments):
+                    if len(ready[j]) > 0:
+                        rows = numpy.array(ready[j])
+                        e.write(rows, files[j])
+                        sketches[j].update(rows)
+                        sketches[j].save(sketch.sketch_filename(e.filename))
+                        ready[j] = []
+                        if position[j] == len(todo[j]):
+                            files[j].close()
+                            if report:
+                                print('Saving file...\n   {}'.format(e.filename))
+                last_write = time.time()
+            if result is None:
+                break
+    except Exception as error:
+        errors.append(error)
+    finally:
+        for f in files:
+            f.close()
+
+
+def _format_time (time):
+    h = time//3600
+    m = (time - 3600*(time//3600))//60
+    s = time%60
+    if h:
+        return '{:.0f}h {:.0f}m'.format(h, m)
+    elif m:
+        return '{:.0f}m {:.0f}s'.format(m, s)
+    else:
+        return '{:.1f}s'.format(s)
 
 
 if __name__ == '__main__':
@@ -224,118 +866,329 @@ if __name__ == '__main__':
                         action = 'store_true',
                         help = 'run {:,} simulations and write or overwrite.' \
                                ''.format(SIMULATIONS))
+    parser.add_argument('-r','--resume',
+                        action = 'store_true',
+                        help = 'resume an interrupted run: keep the complete ' \
+                               'rows already in the file, trim a torn last ' \
+                               'write and run only the missing simulations.')
     parser.add_argument('-p', '--pop_size',
                         action = 'store',
+                        nargs = '+',
                         type = float,
-                        default = CONSTANT_POP_SIZE,
+                        default = [CONSTANT_POP_SIZE],
                         help = 'constant population size, in thousands. ' \
                                '(default {}).'.format(CONSTANT_POP_SIZE))
     parser.add_argument('--homogamy',
                         action = 'store',
+                        nargs = '+',
                         type = float,
-                        default = aa_HOMOGAMY,
+                        default = [aa_HOMOGAMY],
                         help = 'deaf-deaf assortative mating (homogamy) ' \
                                '(default {}).'.format(aa_HOMOGAMY))
     parser.add_argument('-f', '--fitness',
                         action = 'store',
+                        nargs = '+',
                         type = float,
-                        default = aa_FITNESS,
+                        default = [aa_FITNESS],
                         help = 'the relative reproductive fitness of deaf ' \
                                'individuals (default {}).'.format(aa_FITNESS))
+    parser.add_argument('-e', '--engine',
+                        action = 'store',
+                        choices = sorted(CHOOSERS) + ['aggregate'],
+                        default = 'python',
+                        help = 'the simulation engine. "python" uses ' \
+                               'customChooser; "numpy" uses the vectorized ' \
+                               'numpyChooser; "aggregate" tracks genotype ' \
+                               'counts only (default python).')
+    parser.add_argument('-b', '--batch',
+                        action = 'store',
+                        type = int,
+                        default = None,
+                        help = 'with --engine aggregate, advance blocks of ' \
+                               'BATCH replicates together in one process.')
+    parser.add_argument('-s', '--seed',
+                        action = 'store',
+                        type = int,
+                        default = None,
+                        help = 'master seed from which each replicate\'s seed ' \
+                               'is derived (default: a fresh random seed, ' \
+                               'recorded in the file metadata).')
+    parser.add_argument('--shard',
+                        action = 'store',
+                        default = None,
+                        help = 'run only shard i of N of the {:,} ' \
+                               'simulations, given as i/N. Requires --seed. ' \
+                               'Use merge.py to combine the shard files.' \
+                               ''.format(SIMULATIONS))
+    parser.add_argument('--tolerance',
+                        action = 'store',
+                        type = float,
+                        default = None,
+                        help = 'adaptive mode: stop a configuration once the ' \
+                               '95%% CIs of the endpoint 2%%, 50%% and 98%% ' \
+                               'quantiles of the --tolerance_fields are all ' \
+                               'narrower than this.')
+    parser.add_argument('--tolerance_fields',
+                        action = 'store',
+                        nargs = '+',
+                        default = ['a', 'aa'],
+                        help = 'the fields checked in adaptive mode ' \
+                               '(default a aa).')
+    parser.add_argument('--min_replicates',
+                        action = 'store',
+                        type = int,
+                        default = ADAPTIVE_MIN,
+                        help = 'the fewest simulations in adaptive mode ' \
+                               '(default {:,}).'.format(ADAPTIVE_MIN))
+    parser.add_argument('--max_replicates',
+                        action = 'store',
+                        type = int,
+                        default = SIMULATIONS,
+                        help = 'the number of simulations, or the most in ' \
+                               'adaptive mode (default {:,}).'.format(SIMULATIONS))
     args=parser.parse_args()
+    if args.tolerance is not None:
+        if args.shard is not None:
+            parser.error('--tolerance cannot be used with --shard, since ' \
+                         'shards must have fixed sizes.')
+        unknown = [field for field in args.tolerance_fields if field not in FIELDS]
+        if len(unknown) > 0:
+            parser.error('unknown --tolerance_fields {}.'.format(unknown))
+    if args.batch is not None and args.engine != 'aggregate':
+        parser.error('--batch requires --engine aggregate.')
+    if args.shard is not None:
+        if re.match(r'^\d+/\d+$', args.shard) is None or \
+           not 1 <= int(args.shard.split('/')[0]) <= int(args.shard.split('/')[1]):
+            parser.error('--shard must be given as i/N, with 1 <= i <= N.')
+        if args.seed is None:
+            parser.error('--shard requires --seed, so that all shards share ' \
+                         'the same master seed.')
+    seed = args.seed if args.seed is not None else numpy.random.SeedSequence().entropy
 
-    experiment = fileio.Experiment(constant_pop_size   = args.pop_size,
-                                   a                   = a_FREQ,
-                                   aa_fitness          = args.fitness,
-                                   aa_homogamy         = args.homogamy,
-                                   deaf                = DEAF_FREQ,
-                                   generations         = GENERATIONS,
-                                   simuPOP_version     = sim.__version__)
-
-    experiment.cpu = subprocess.check_output(['/usr/sbin/sysctl', "-n", \
-                                     "machdep.cpu.brand_string"]).decode().strip() + \
-                                     " ({} threads)".format(multiprocessing.cpu_count())
-
-    if not (args.write or args.overwrite):
-        # just show the results from the quick sample run and exit
-        sample_run = simuAssortativeMatingWithFitness(experiment)
-        print(experiment.metadata())
-        numcols = sample_run['headers'][1:].index("gen") + 1
-        for h in sample_run['headers'][0:numcols]:
-            print("{h:>9}".format(h=h), end=' ')
-        print()
-        for h in sample_run['headers'][0:numcols]:
-            print(" --------", end=' ')
-        print()
-        for gen in range(0,len(sample_run['row'])//numcols):
-            for datum in sample_run['row'][numcols*gen:numcols*(1+gen)]:
-                if type(datum) is int or datum == int(datum):
-                    print(" {datum:>8,}".format(datum=int(datum)), end=' ')
-                else:
-                    print(" {datum:>8.6f}".format(datum=datum), end=' ')
+    # Passing several values to --pop_size, --homogamy or --fitness sweeps
+    # over every combination. Each configuration has its own Experiment.
+    cpu = subprocess.check_output(['/usr/sbin/sysctl', "-n", \
+                                  "machdep.cpu.brand_string"]).decode().strip() + \
+                                  " ({} threads)".format(multiprocessing.cpu_count())
+    experiments = []
+    for pop_size, homogamy, fitness in itertools.product(args.pop_size,
+                                                         args.homogamy,
+                                                         args.fitness):
+        experiment = fileio.Experiment(constant_pop_size   = pop_size,
+                                       a                   = a_FREQ,
+                                       aa_fitness          = fitness,
+                                       aa_homogamy         = homogamy,
+                                       deaf                = DEAF_FREQ,
+                                       generations         = GENERATIONS,
+                                       engine              = args.engine,
+                                       batch               = args.batch,
+                                       simulations         = args.max_replicates,
+                                       tolerance           = args.tolerance,
+                                       seed                = seed,
+                                       shard               = args.shard,
+                                       simuPOP_version     = sim.__version__)
+        experiment.cpu = cpu
+        experiments.append(experiment)
+
+    if not (args.write or args.overwrite or args.resume):
+        # just show the results from the quick sample run(s) and exit
+        for experiment in experiments:
+            sample_run = simulate(experiment)
+            print(experiment.metadata())
+            for h in sample_run['headers']:
+                print("{h:>9}".format(h=h), end=' ')
+            print()
+            for h in sample_run['headers']:
+                print(" --------", end=' ')
+            print()
+            for row in sample_run['data']:
+                for datum in row:
+                    if datum == int(datum):
+                        print(" {datum:>8,}".format(datum=int(datum)), end=' ')
+                    else:
+                        print(" {datum:>8.6f}".format(datum=datum), end=' ')
+                print()
             print()
         print('Done.')
         exit()
     else:
         if fileio.create_folder(args.path):
             print('Created folder...\n   {}'.format(args.path))
-        experiment.filename = os.path.join(args.path,
-                                           'pop{experiment.constant_pop_size}k'\
-                                           '_hom{experiment.aa_homogamy:.2}'   \
-                                           '_fit{experiment.aa_fitness}'       \
-                                           '.tsv'.format(**locals()))
-        if os.path.isfile(experiment.filename):
-            if not args.overwrite:
-                print('File already exists. Use --overwrite.\n   {}'.format(experiment.filename))
-                exit()
+        pending = []
+        todo = []
+        rows = []
+        sketches = []
+        for experiment in experiments:
+            experiment.filename = os.path.join(args.path,
+                                               'pop{experiment.constant_pop_size}k'\
+                                               '_hom{experiment.aa_homogamy:.2}'   \
+                                               '_fit{experiment.aa_fitness}'       \
+                                               '.tsv'.format(**locals()))
+            if args.shard is not None:
+                experiment.filename = experiment.filename.replace('.tsv',
+                        '_shard{}of{}.tsv'.format(*args.shard.split('/')))
+            experiment.headers = FIELDS * experiment.generations
+            sims = 0
+            if os.path.isfile(experiment.filename):
+                if args.resume:
+                    existing = fileio.Experiment(experiment.filename)
+                    params = list(fileio.INDEP_VARS)
+                    if str(getattr(existing, 'seed', None)) != 'None':
+                        # continue with the file's own master seed
+                        if args.seed is None:
+                            experiment.seed = int(existing.seed)
+                        params += ['seed']
+                    if [str(getattr(existing, var, None)) for var in params] != \
+                       [str(getattr(experiment, var)) for var in params] or \
+                       existing.headers != experiment.headers:
+                        print('File has different parameters; cannot resume.\n   {}'.format(experiment.filename))
+                        continue
+                    # files from before --engine was added were all written
+                    # with customChooser
+                    engine = str(getattr(existing, 'engine', None))
+                    if (engine if engine != 'None' else 'python') != experiment.engine:
+                        print('File was written with the {} engine; cannot ' \
+                              'resume with {}.\n   {}'.format(engine,
+                              experiment.engine, experiment.filename))
+                        continue
+                    # batched replicates depend on the block size
+                    if str(getattr(existing, 'batch', None)) != str(experiment.batch):
+                        print('File was written with --batch {}; cannot ' \
+                              'resume with --batch {}.\n   {}'.format(
+                              getattr(existing, 'batch', None), experiment.batch,
+                              experiment.filename))
+                        continue
+                    sims = experiment.count_rows(trim=True)
+                    print('Resuming file with {:,} simulations...\n   {}'.format(sims, experiment.filename))
+                elif not args.overwrite:
+                    print('File already exists. Use --overwrite or --resume.\n   {}'.format(experiment.filename))
+                    continue
+                else:
+                    print('Overwriting file...\n   {}'.format(experiment.filename))
+                    experiment.write_metadata(overwrite=True)
             else:
-                print('Overwriting file...\n   {}'.format(experiment.filename))
+                print('Creating file...\n   {}'.format(experiment.filename))
+                experiment.write_metadata(overwrite=True)
+            print(experiment.metadata())
+            replicates = shard_range(args.shard, args.max_replicates)[sims:]
+            if len(replicates) > 0:
+                pending.append(experiment)
+                todo.append(replicates)
+                rows.append(sims)
+                sketches.append(_open_sketch(experiment, sims))
+        if len(pending) == 0:
+            exit()
+        total = sum(len(replicates) for replicates in todo)
+        print('Running {}{:,} simulations for {} configuration(s)...' \
+              ''.format('up to ' if args.tolerance is not None else '',
+                        total, len(pending)))
+
+        # Without --tolerance, every simulation runs in one round. With it,
+        # each configuration runs in rounds, until the CIs of its endpoint
+        # quantiles are narrow enough or it reaches --max_replicates.
+        done = list(rows)
+        sims = 0
+        sweep_start = last_report = time.time()
+        if args.batch is None:
+            pool = multiprocessing.Pool(initializer=_init_worker, initargs=(pending,))
         else:
-            print('Creating file...\n   {}'.format(experiment.filename))
-        sample_run = simuAssortativeMatingWithFitness(experiment)
-        experiment.headers = sample_run['headers']
-        experiment.write_metadata(overwrite=True)
-        print(experiment.metadata())
-        print('Running {:,} simulations...'.format(SIMULATIONS))
-
-        def _worker():
-            '''
-                The worker function exists as a convenient way of passing
-                simuAssortativeMatingWithFitness with its parameters to the
-                multiprocessing pool.
-            '''
-            return simuAssortativeMatingWithFitness(experiment)['row']
-
-        def _format_time (time):
-            h = time//3600
-            m = (time - 3600*(time//3600))//60
-            s = time%60
-            if h:
-                return '{:.0f}h {:.0f}m'.format(h, m)
-            elif m:
-                return '{:.0f}m {:.0f}s'.format(m, s)
+            # the last block run for each configuration, which the next
+            # adaptive round may continue
+            blocks = [{} for experiment in pending]
+        while True:
+            if args.tolerance is None:
+                rounds, todo = todo, [[] for replicates in todo]
             else:
-                return '{:.1f}s'.format(s)
+                rounds = []
+                for i in range(len(pending)):
+                    if done[i] >= args.min_replicates and \
+                       _ci_width(sketches[i], args.tolerance_fields) <= args.tolerance:
+                        n = 0
+                    else:
+                        n = max(args.min_replicates - done[i], ADAPTIVE_CHUNK)
+                    rounds.append(todo[i][:n])
+                    todo[i] = todo[i][n:]
+            if sum(len(replicates) for replicates in rounds) == 0:
+                break
 
-        mp_chunk_size = cpu_count = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool()
-        sims = 0
-        while sims < SIMULATIONS:
-            start_time = time.time()
-            p = [pool.apply_async(_worker) for i in range(mp_chunk_size)]
-            table = [item.get() for item in p]
-            experiment.write(table)
-            sims += mp_chunk_size
-            rate = mp_chunk_size/(time.time()-start_time)
-            time_remaining = (SIMULATIONS-sims)/rate if rate > 0 else 0
-            print('   {:,} simulations completed ' \
-                  '({:,.0f}/min) '\
-                  '{} remaining.'\
-                  ''.format(sims, 60*rate, _format_time(time_remaining)))
-            # mp_chunk_size is dynamically adjusted based on actual
-            # execution speed such that file writes occur once per minute.
-            mp_chunk_size = max(int(300*rate - 300*rate%cpu_count), cpu_count)
-            if sims + mp_chunk_size > SIMULATIONS:
-                mp_chunk_size = SIMULATIONS-sims
-        print('Saving file...\n   {}'.format(experiment.filename))
+            if args.batch is not None:
+                # blocks of replicates advance together in this process; a pool
+                # would only add overhead at this cost per block.
+                for i, (experiment, replicates, s) in enumerate(zip(pending, rounds, sketches)):
+                    for data in batch_blocks(experiment, replicates, args.batch,
+                                             blocks[i]):
+                        experiment.write(data)
+                        s.update(data)
+                        s.save(sketch.sketch_filename(experiment.filename))
+                        sims += len(data)
+                        rate = sims/(time.time()-sweep_start)
+                        print('   {:,} of {:,} simulations completed ' \
+                              '({:,.0f}/min) '\
+                              '{} remaining.'\
+                              ''.format(sims, total, 60*rate,
+                                        _format_time((total-sims)/rate)))
+                    done[i] += len(replicates)
+                    if len(replicates) > 0 and args.tolerance is None:
+                        print('Saving file...\n   {}'.format(experiment.filename))
+            else:
+                # Every (configuration, replicate) task goes through one shared
+                # pool, in configuration order. Results are taken as soon as any
+                # worker finishes, so the pool never waits at a chunk boundary,
+                # and they are handed to the writer thread, which puts them in
+                # order.
+                tasks = [(i, replicate) for i in range(len(pending))
+                                        for replicate in rounds[i]]
+                results = queue.Queue()
+                errors = []
+                writer = threading.Thread(target=_writer, args=(results, pending,
+                                                                rounds, sketches,
+                                                                errors),
+                                          kwargs={'report': args.tolerance is None})
+                writer.start()
+                # replicates are handed out in chunks to cut task overhead, while
+                # keeping enough chunks to balance the load across workers
+                chunksize = max(1, min(16, len(tasks)//(4*multiprocessing.cpu_count())))
+                try:
+                    for result in pool.imap_unordered(_task, tasks, chunksize):
+                        if len(errors) > 0:
+                            # the writer has failed; there is no point going on
+                            break
+                        results.put(result)
+                        sims += 1
+                        if time.time() - last_report > 10 or sims == total:
+                            last_report = time.time()
+                            rate = sims/(last_report-sweep_start)
+                            print('   {:,} of {:,} simulations completed ' \
+                                  '({:,.0f}/min) '\
+                                  '{} remaining.'\
+                                  ''.format(sims, total, 60*rate,
+                                            _format_time((total-sims)/rate)))
+                except BaseException:
+                    # e.g. a failed simulation or Ctrl-C
+                    pool.terminate()
+                    raise
+                finally:
+                    # the writer always writes the rows it holds, and ends
+                    results.put(None)
+                    writer.join()
+                if len(errors) > 0:
+                    pool.terminate()
+                    raise errors[0]
+                for i in range(len(pending)):
+                    done[i] += len(rounds[i])
+            if args.tolerance is None:
+                break
+        if args.batch is None:
+            pool.close()
+
+        if args.tolerance is not None:
+            # record how many replicates were needed, and the CI width reached
+            for experiment, s, n in zip(pending, sketches, done):
+                e = fileio.Experiment(experiment.filename, lazy=True)
+                e.tolerance = args.tolerance
+                e.replicates = n
+                e.ci_width = '{:.6g}'.format(_ci_width(s, args.tolerance_fields))
+                e.rewrite_metadata()
+                print('Saving file with {:,} simulations (CI width {})...\n   {}' \
+                      ''.format(n, e.ci_width, experiment.filename))
         exit()
@@ -0,0 +1,237 @@
+#!/usr/local/bin/python3 -u
+# -*- coding: utf-8 -*-
+# We generally follow PEP 8: http://legacy.python.org/dev/peps/pep-0008/
+
+'''
+*Derek C. Braun, Brian H. Greenwald, Samir Jain, Eric Epstein, Brienna Herold, Maggie Gray
+(*derek.braun@gallaudet.edu)
+
+Mergeable streaming quantile sketches with running moments. simulator.py keeps
+one sketch per data file, covering every (generation, field) column, and saves
+it to a small sidecar file next to the data file. grapher.py and stats.py can
+then draw bands and report medians from the sidecar without reading the data,
+even while a run is still in progress.
+'''
+
+import os
+import numpy
+
+
+def sketch_filename(filename):
+    '''
+        Returns the name of the sidecar file for a data file.
+    '''
+    return os.path.splitext(filename)[0] + '.sketch.npz'
+
+
+class QuantileSketch:
+    '''
+        A KLL-style quantile sketch for many columns at once. Every column
+        receives one value per row, so all columns share the same structure:
+        level h holds items of weight 2**h. When a level has more than k
+        items, it is sorted (each column separately) and every other item,
+        starting at a random offset, moves up a level. The rank error is
+        about 1/k of the number of rows, whatever the number of rows.
+
+        The count, mean, sum of squared deviations, minimum and maximum of
+        every column are kept exactly. Sketches with the same columns can be
+        merged, e.g. those of shard files.
+    '''
+    def __init__(self, headers, k=256, seed=None):
+        '''
+            Accepts:
+                headers         the header of each column
+                k               the capacity of each level
+                seed            an optional seed for the compaction offsets
+        '''
+        self.headers = list(headers)
+        self.k = k
+        self.rng = numpy.random.default_rng(seed)
+        columns = len(self.headers)
+        self.levels = []
+        self.count = 0
+        self.mean = numpy.zeros(columns)
+        self.m2 = numpy.zeros(columns)
+        self.min = numpy.full(columns, numpy.inf)
+        self.max = numpy.full(columns, -numpy.inf)
+
+
+    def update(self, rows):
+        '''
+            Adds rows of data.
+
+            Accepts:
+                rows            an array of shape (rows, columns), or of any
+                                shape that reshapes to it, e.g.
+                                (replicates, generations, fields)
+        '''
+        rows = numpy.asarray(rows, dtype=float).reshape(-1, len(self.headers))
+        if len(rows) == 0:
+            return
+        mean = rows.mean(axis=0)
+        self._merge_moments(len(rows), mean, ((rows - mean)**2).sum(axis=0),
+                            rows.min(axis=0), rows.max(axis=0))
+        self._add(0, rows)
+        self._compress()
+
+
+    def merge(self, other):
+        '''
+            Merges another sketch with the same headers into this one.
+        '''
+        if other.headers != self.headers:
+            raise ValueError('Sketches with different headers cannot be merged.')
+        if other.count == 0:
+            return
+        self._merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+        for h, level in enumerate(other.levels):
+            self._add(h, level)
+        self._compress()
+
+
+    def _merge_moments(self, n, mean, m2, low, high):
+        '''
+            Internal method which merges the moments of n rows, using the
+            pairwise update of Chan et al.
+        '''
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n/total
+        self.m2 = self.m2 + m2 + delta**2 * self.count*n/total
+        self.count = total
+        self.min = numpy.minimum(self.min, low)
+        self.max = numpy.maximum(self.max, high)
+
+
+    def _add(self, h, items):
+        while len(self.levels) <= h:
+            self.levels.append(numpy.empty((0, len(self.headers))))
+        self.levels[h] = numpy.concatenate((self.levels[h], items))
+
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.k:
+                level = numpy.sort(self.levels[h], axis=0)
+                # with an odd number of items, the largest stays behind
+                n = len(level) - len(level) % 2
+                self._add(h+1, level[self.rng.integers(2):n:2])
+                self.levels[h] = level[n:]
+            h += 1
+
+
+    def columns(self, param):
+        '''
+            Returns the indices of the columns with header param, which are
+            in generation order.
+        '''
+        return [i for i, h in enumerate(self.headers) if h == param]
+
+
+    def quantile(self, q, param=None):
+        '''
+            Estimates quantiles.
+
+            Accepts:
+                q               a quantile or a sequence of quantiles, from
+                                0 to 1
+                param           an optional header; if given, only its
+                                columns are returned
+
+            Returns a float array of shape (len(q), columns), or (columns,)
+            if q is a single quantile.
+        '''
+        cols = list(range(len(self.headers))) if param is None else self.columns(param)
+        qs = numpy.atleast_1d(numpy.asarray(q, dtype=float))
+        if self.count == 0:
+            estimate = numpy.full((len(qs), len(cols)), numpy.nan)
+        else:
+            items = numpy.concatenate([level[:,cols] for level in self.levels])
+            weights = numpy.concatenate([numpy.full(len(level), 2.**h)
+                                         for h, level in enumerate(self.levels)])
+            order = numpy.argsort(items, axis=0)
+            items = numpy.take_along_axis(items, order, axis=0)
+            cumulative = numpy.cumsum(weights[order], axis=0)
+            estimate = numpy.empty((len(qs), len(cols)))
+            for j, p in enumerate(qs):
+                i = numpy.argmax(cumulative >= p*cumulative[-1], axis=0)
+                estimate[j] = items[i, numpy.arange(len(cols))]
+            # the exact extremes are known
+            estimate[qs <= 0] = self.min[cols]
+            estimate[qs >= 1] = self.max[cols]
+        return estimate if numpy.ndim(q) > 0 else estimate[0]
+
+
+    def interval(self, q, param, z=1.96):
+        '''
+            Estimates a distribution-free confidence interval for quantile
+            q of each column of param, from the ranks that a binomial
+            approximation gives for the order statistics.
+
+            Accepts:
+                q               a quantile, from 0 to 1
+                param           a header
+                z               the normal quantile of the confidence
+                                level; 1.96 for 95%
+
+            Returns two float arrays, the low and high ends, with one value
+            per column of param.
+        '''
+        half = z*numpy.sqrt(q*(1-q)/max(self.count, 1))
+        low, high = self.quantile([max(0., q-half), min(1., q+half)], param)
+        return low, high
+
+
+    def sample(self, param, n=1000):
+        '''
+            Returns a representative sample of the values of param: n
+            evenly spaced quantiles for each generation. It can be passed
+            wherever data from Experiment.select(param) are expected.
+
+            Returns a float array of shape (generations, n).
+        '''
+        return self.quantile((numpy.arange(n) + 0.5)/n, param).T
+
+
+    def std(self):
+        '''
+            Returns the sample standard deviation of each column.
+        '''
+        if self.count < 2:
+            return numpy.full(len(self.headers), numpy.nan)
+        return numpy.sqrt(self.m2/(self.count - 1))
+
+
+    def save(self, filename):
+        '''
+            Saves the sketch. The file is replaced atomically, so readers
+            never see a partly written sketch.
+        '''
+        arrays = {'level_{}'.format(h): level for h, level in enumerate(self.levels)}
+        temp = filename + '.tmp'
+        f = open(temp, 'wb')
+        numpy.savez(f, headers=numpy.array(self.headers), k=self.k,
+                    count=self.count, mean=self.mean, m2=self.m2,
+                    min=self.min, max=self.max, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(temp, filename)
+
+
+    @classmethod
+    def load(cls, filename, seed=None):
+        '''
+            Loads a sketch saved with save.
+        '''
+        with numpy.load(filename) as f:
+            sketch = cls(f['headers'].tolist(), k=int(f['k']), seed=seed)
+            sketch.count = int(f['count'])
+            for key in ('mean', 'm2', 'min', 'max'):
+                setattr(sketch, key, f[key])
+            h = 0
+            while 'level_{}'.format(h) in f:
+                sketch.levels.append(f['level_{}'.format(h)])
+                h += 1
+        return sketch
@@ -18,8 +18,202 @@ import os
 import argparse
 import numpy
 import random
+import multiprocessing
 import fileio
-from scipy import stats
+import sketch
+from scipy import stats, special
+
+POSTHOC_TESTS = ['mannwhitney', 'dunn']
+CORRECTIONS = ['holm', 'bonferroni', 'none']
+# resamples are drawn in blocks of about this many bytes per array, so
+# memory use does not grow with the number of resamples
+BLOCK_BYTES = 2**26
+
+
+def posthoc(samples, test='mannwhitney', correction='holm'):
+    '''
+        All-pairs post-hoc test. The pooled data are sorted once, and every
+        pairwise statistic is computed from the counts of each sample at
+        each distinct value, so no pair is ranked again.
+
+        mannwhitney gives the same two-sided p-values as
+        stats.mstats.mannwhitneyu: a normal approximation with tie and
+        continuity corrections. dunn is Dunn's test on the pooled ranks,
+        with a tie correction.
+
+        Accepts:
+            samples         a list of 1-d arrays
+            test            one of POSTHOC_TESTS
+            correction      one of CORRECTIONS; holm and bonferroni adjust
+                            for the number of pairs
+
+        Returns a (samples, samples) symmetric array of p-values, with
+        ones on the diagonal.
+    '''
+    k = len(samples)
+    n = numpy.array([len(X) for X in samples], dtype=float)
+    values, inverse = numpy.unique(numpy.concatenate(samples),
+                                   return_inverse=True)
+    group = numpy.repeat(numpy.arange(k), n.astype(int))
+    # counts[g, v] is the number of values of sample g equal to values[v]
+    counts = numpy.bincount(group*len(values) + inverse.ravel(),
+                            minlength=k*len(values)).reshape(k, -1)
+    counts = counts.astype(float)
+    if test == 'mannwhitney':
+        below = numpy.cumsum(counts, axis=1) - counts
+        # U[i, j] counts the pairs in which sample i is the larger, ties 1/2
+        U = counts @ (below + 0.5*counts).T
+        U = numpy.maximum(U, U.T)
+        nn = numpy.outer(n, n)
+        nt = n[:,None] + n[None,:]
+        # sum over values of t**3 - t, where t is the pair's tie count
+        c3 = (counts**3).sum(axis=1)
+        ties = c3[:,None] + c3[None,:] + \
+               3*(counts**2 @ counts.T + counts @ (counts**2).T) - nt
+        sigma = numpy.sqrt((nt**3 - nt - ties)/12. * nn/(nt*(nt-1)))
+        z = (U - 0.5 - nn/2.)/sigma
+    elif test == 'dunn':
+        N = n.sum()
+        t = counts.sum(axis=0)
+        # the mean pooled rank of each distinct value, with ties averaged
+        ranks = numpy.cumsum(t) - (t-1)/2.
+        mean_rank = counts @ ranks / n
+        ties = (t**3 - t).sum()/(12.*(N-1))
+        sigma = numpy.sqrt((N*(N+1)/12. - ties) *
+                           (1/n[:,None] + 1/n[None,:]))
+        z = (mean_rank[:,None] - mean_rank[None,:])/sigma
+    else:
+        raise ValueError('Unknown post-hoc test {}.'.format(test))
+    p = special.erfc(numpy.abs(z)/numpy.sqrt(2))
+    i, j = numpy.tril_indices(k, -1)
+    pairs = p[i, j]
+    if correction == 'bonferroni':
+        pairs = numpy.minimum(1, pairs*len(pairs))
+    elif correction == 'holm':
+        order = numpy.argsort(pairs)
+        adjusted = numpy.maximum.accumulate(pairs[order] *
+                                            (len(pairs) - numpy.arange(len(pairs))))
+        pairs[order] = numpy.minimum(1, adjusted)
+    elif correction != 'none':
+        raise ValueError('Unknown correction {}.'.format(correction))
+    p = numpy.ones((k, k))
+    p[i, j] = p[j, i] = pairs
+    return p
+
+def _block_sizes(resamples, n):
+    '''
+        Internal function which splits resamples of n values into blocks.
+    '''
+    size = max(1, BLOCK_BYTES//(8*n))
+    return [min(size, resamples - i) for i in range(0, resamples, size)]
+
+
+def _seed_sequence(seed):
+    '''
+        Internal function which returns seed as a numpy SeedSequence.
+    '''
+    if isinstance(seed, numpy.random.SeedSequence):
+        return seed
+    return numpy.random.SeedSequence(seed)
+
+
+def _quantile(Z, counts, q):
+    '''
+        Internal function which returns, for each row of counts of the
+        values of a sorted array Z, quantile q of the values counted, with
+        the linear interpolation of numpy.quantile, so that q=0.5 gives
+        numpy.median.
+    '''
+    cumulative = numpy.cumsum(counts, axis=1)
+    n = cumulative[:,-1]
+    h = q*(n - 1)
+    lower = numpy.floor(h)
+    # the values of the order statistics either side of h
+    below = Z[numpy.argmax(cumulative > lower[:,None], axis=1)]
+    above = Z[numpy.argmax(cumulative > numpy.minimum(lower + 1, n - 1)[:,None],
+                           axis=1)]
+    return below + (h - lower)*(above - below)
+
+
+def _bootstrap_block(job):
+    '''
+        Worker function which computes quantiles of one block of bootstrap
+        resamples. Each resample is a row of random indices into X.
+    '''
+    X, q, size, seed = job
+    n = len(X)
+    rng = numpy.random.default_rng(seed)
+    index = rng.integers(n, size=(size, n)) + n*numpy.arange(size)[:,None]
+    counts = numpy.bincount(index.ravel(), minlength=size*n).reshape(size, n)
+    return numpy.array([_quantile(X, counts, p) for p in q])
+
+
+def bootstrap(X, q=(0.5,), resamples=10000, seed=None, pool=None):
+    '''
+        Bootstrap distribution of quantiles of X. Resamples are drawn as
+        index matrices, one block at a time, and counted against the sorted
+        data, so no resample is sorted. Blocks run in parallel if a pool is
+        given, and the result depends only on the seed.
+
+        Accepts:
+            X               a 1-d array
+            q               a sequence of quantiles, from 0 to 1
+            resamples       the number of bootstrap resamples
+            seed            an optional int or numpy SeedSequence
+            pool            an optional multiprocessing.Pool
+
+        Returns a float array of shape (len(q), resamples).
+    '''
+    X = numpy.sort(X)
+    sizes = _block_sizes(resamples, len(X))
+    seeds = _seed_sequence(seed).spawn(len(sizes))
+    jobs = [(X, q, size, s) for size, s in zip(sizes, seeds)]
+    blocks = (pool.map if pool is not None else map)(_bootstrap_block, jobs)
+    return numpy.concatenate(list(blocks), axis=1)
+
+
+def _permutation_block(job):
+    '''
+        Worker function which computes the difference between the medians
+        of the two groups for one block of permutations of the pooled,
+        sorted data. Each permutation is a row of group labels.
+    '''
+    Z, n1, size, seed = job
+    rng = numpy.random.default_rng(seed)
+    labels = numpy.zeros((size, len(Z)), dtype=bool)
+    labels[:,:n1] = True
+    labels = rng.permuted(labels, axis=1)
+    return _quantile(Z, ~labels, 0.5) - _quantile(Z, labels, 0.5)
+
+
+def permutation_test(X, Y, resamples=10000, seed=None, pool=None):
+    '''
+        Two-sided permutation test of the difference between the medians of
+        X and Y. Permutations are drawn in blocks, which run in parallel if
+        a pool is given.
+
+        Accepts:
+            X, Y            1-d arrays
+            resamples       the number of permutations
+            seed            an optional int or numpy SeedSequence
+            pool            an optional multiprocessing.Pool
+
+        Returns the difference between the medians of Y and X, and its
+        p-value.
+    '''
+    X = numpy.sort(X)
+    Y = numpy.sort(Y)
+    Z = numpy.sort(numpy.concatenate((X, Y)))
+    observed = numpy.median(Y) - numpy.median(X)
+    sizes = _block_sizes(resamples, len(Z))
+    seeds = _seed_sequence(seed).spawn(len(sizes))
+    jobs = [(Z, len(X), size, s) for size, s in zip(sizes, seeds)]
+    blocks = (pool.map if pool is not None else map)(_permutation_block, jobs)
+    differences = numpy.concatenate(list(blocks))
+    # the tolerance keeps ties with the observed difference
+    extreme = numpy.abs(differences) >= abs(observed) - 1e-12
+    return observed, (1 + extreme.sum())/(1 + resamples)
+
 
 #
 #   MAIN ROUTINE
@@ -33,6 +227,35 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--field', action='store',
                         required = True,
                         help = 'the variable to compare among populations. a, aa, or F.')
+    parser.add_argument('--posthoc', action='store',
+                        choices = POSTHOC_TESTS,
+                        default = 'mannwhitney',
+                        help = 'the post-hoc test after Kruskal-Wallis. ' \
+                               '(default mannwhitney).')
+    parser.add_argument('--correction', action='store',
+                        choices = CORRECTIONS,
+                        default = 'holm',
+                        help = 'the multiple-comparison correction of the ' \
+                               'post-hoc p-values. (default holm).')
+    parser.add_argument('--resamples', action='store',
+                        type = int,
+                        default = 10000,
+                        help = 'the number of bootstrap resamples for the ' \
+                               'confidence intervals of the medians; 0 ' \
+                               'skips them. (default 10000).')
+    parser.add_argument('--permutations', action='store',
+                        type = int,
+                        default = 0,
+                        help = 'the number of permutations for tests of the ' \
+                               'difference in medians between each file and ' \
+                               'the first. (default 0, no tests).')
+    parser.add_argument('--seed', action='store',
+                        type = int,
+                        default = None,
+                        help = 'seed for the resampling.')
+    parser.add_argument('--sketch', action='store_true',
+                        help = 'only report the summary statistics, estimated ' \
+                               'from the quantile sketch sidecar files.')
     args=parser.parse_args()
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -43,7 +266,7 @@ if __name__ == '__main__':
     for filename in args.filenames:
         # Check to see if each individual file exists
         if os.path.isfile(filename):
-            experiments.append(fileio.Experiment(filename))
+            experiments.append(fileio.Experiment(filename, lazy=True))
             print('   {}'.format(filename))
         else:
             print('   File {} not found.'.format(filename))
@@ -56,18 +279,70 @@ if __name__ == '__main__':
                   ''.format(args.field, e.filename))
             exit()
 
+    if args.sketch:
+        print()
+        print('** Summary Statistics for "{}" (sketch) **'.format(args.field))
+        print('{:30}   {:^8}   {:^8}  {:^21}'.format('', 'count', 'end', ''))
+        print('{:30}   {:^8}   {:^8}  {:^21}'.format('filename','','(median)','95% CI'))
+        for e in experiments:
+            if not os.path.isfile(sketch.sketch_filename(e.filename)):
+                print('{:30}   sketch not found'.format(e.filename))
+                continue
+            s = sketch.QuantileSketch.load(sketch.sketch_filename(e.filename))
+            # the endpoint is the last generation's column
+            median, low, high = s.quantile([0.5, 0.025, 0.975], args.field)[:,-1]
+            ci = '({:0.6f} - {:0.6f})'.format(low, high)
+            print('{:30}   {:<8,}   {:0.6f}  {:^21}'.format(e.filename, s.count,
+                                                            median, ci))
+        print('Done. ')
+        exit()
+
     print()
     print('** Summary Statistics for "{}" **'.format(args.field))
     print('{:30}   {:^8}   {:^8}  {:^21}'.format('', 'start', 'end', ''))
     print('{:30}   {:^8}   {:^8}  {:^21}'.format('filename','(median)','(median)','95% CI'))
     for e in experiments:
-        # select first and last set of values
-        X = e.select_endpoint(args.field)
-        end_median = numpy.median(X)
-        X.sort()
+        # sorted endpoint values and their median are cached next to the file
+        X = e.sorted_endpoint(args.field)
+        end_median = e.median(args.field)
         ci = '({:0.6f} - {:0.6f})'.format(X[int(0.025*len(X))],
                                       X[int(0.975*len(X))])
         print('{:30}   {:0.6f}  {:^21}'.format(e.filename, end_median, ci))
+    if args.resamples > 0 or args.permutations > 0:
+        print()
+        print('** Bootstrap 95% CIs for the median of "{}" ({:,} resamples) **' \
+              ''.format(args.field, args.resamples))
+        print('{:30}   {:^8}  {:^21}   {:^9}  {:^23}   {:^8}'.format('filename',
+              'median', '95% CI', 'vs first', '95% CI', 'p-value'))
+        pool = multiprocessing.Pool()
+        seeds = numpy.random.SeedSequence(args.seed).spawn(2*len(experiments))
+        medians = []
+        for i, e in enumerate(experiments):
+            X = e.sorted_endpoint(args.field)
+            line = '{:30}   {:0.6f}'.format(e.filename, e.median(args.field))
+            if args.resamples > 0:
+                # resamples of different files are independent, so those
+                # of the difference from the first file come for free
+                medians.append(bootstrap(X, resamples=args.resamples,
+                                         seed=seeds[i], pool=pool)[0])
+                low, high = numpy.percentile(medians[i], [2.5, 97.5])
+                line += '  ({:0.6f} - {:0.6f})'.format(low, high)
+            if i > 0:
+                first = experiments[0].sorted_endpoint(args.field)
+                line += '   {:+0.6f}'.format(e.median(args.field) -
+                                             experiments[0].median(args.field))
+                if args.resamples > 0:
+                    low, high = numpy.percentile(medians[i] - medians[0],
+                                                 [2.5, 97.5])
+                    line += '  ({:+0.6f} - {:+0.6f})'.format(low, high)
+                if args.permutations > 0:
+                    d, p = permutation_test(first, X, args.permutations,
+                                            seed=seeds[len(experiments)+i],
+                                            pool=pool)
+                    line += '   {:^8.3g}'.format(p)
+            print(line)
+        pool.close()
+
     print()
     print('** Shapiro-Wilk test of normality for "{}" **'.format(args.field, \
                                                                  filename))
@@ -75,7 +350,7 @@ if __name__ == '__main__':
     data_array = []
     for e in experiments:
         # select last set of values
-        X = e.select_endpoint(args.field)
+        X = e.sorted_endpoint(args.field)
         # Find the mean and stdev,
         data_array.append(X)
         # Thin X to 5,000 values if needed; the maximum for the Shapiro-Wilk
@@ -104,17 +379,18 @@ if __name__ == '__main__':
         print("{:<8.1f}   {:^8.5g}".format(H, p))
         print()
         if p <= 0.5:
-            print('** post-hoc pairwise Mann-Whitney U test for "{}" **' \
-                  ''.format(args.field))
+            print('** post-hoc pairwise {} test for "{}" ({} correction) **' \
+                  ''.format('Mann-Whitney U' if args.posthoc == 'mannwhitney'
+                            else "Dunn's", args.field, args.correction))
+            # every pair comes from one pooled sort of the data
+            P = posthoc(data_array, args.posthoc, args.correction)
             matrix = ''
             for i in range(len(data_array)):
                 for j in range(len(data_array)):
                     if j >= i:
                         matrix += '{:^8}   '.format('-')
                     else:
-                        U, p = stats.mstats.mannwhitneyu(data_array[i],
-                                                         data_array[j])
-                        matrix += '{:^8.3g}   '.format(p)
+                        matrix += '{:^8.3g}   '.format(P[i,j])
                 matrix += '\n'
             print(matrix)
     print('Done. ')
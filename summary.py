@@ -1,4 +1,4 @@
-#!/usr/local/bin/python -u
+#!/usr/local/bin/python3 -u
 # -*- coding: utf-8 -*-
 # We generally follow PEP 8: http://legacy.python.org/dev/peps/pep-0008/
 
@@ -6,17 +6,92 @@
 *Derek C. Braun, Brian H. Greenwald, Samir Jain, Eric Epstein, Brienna Herold, Maggie Gray
 (*derek.braun@gallaudet.edu)
 
-Display a X-Y table showing final median values from data files created by
-simulator.py.
+Display X-Y tables of final values from data files created by simulator.py.
+One table is printed for each field and statistic, e.g. the median and the
+mean of a and aa as functions of fitness and homogamy.
 '''
 
 import sys
 import os
+import glob
 import argparse
+import multiprocessing
 import numpy
-import random
 import fileio
-from scipy import stats
+
+
+def statistic(X, name):
+    '''
+        Computes a statistic of sorted endpoint data.
+
+        Accepts:
+            X               a sorted array
+            name            median, mean, std, or qP for the Pth
+                            percentile, e.g. q2.5 or q97.5
+
+        Returns a float.
+    '''
+    if len(X) == 0:
+        return numpy.nan
+    if name == 'median':
+        return float(numpy.median(X))
+    if name == 'mean':
+        return float(numpy.mean(X))
+    if name == 'std':
+        return float(numpy.std(X, ddof=1)) if len(X) > 1 else numpy.nan
+    if name.startswith('q'):
+        return float(numpy.percentile(X, float(name[1:])))
+    raise ValueError('Unknown statistic {}.'.format(name))
+
+
+def _statistic_name(name):
+    '''
+        Internal function which checks a statistic name for argparse.
+    '''
+    try:
+        statistic(numpy.zeros(1), name)
+    except ValueError:
+        raise argparse.ArgumentTypeError('unknown statistic {}'.format(name))
+    return name
+
+
+def _summarize(job):
+    '''
+        Worker function which reads the endpoints of every field of one
+        file, in one pass, and computes every statistic.
+
+        Accepts:
+            job             a tuple of (filename, fields, statistics, x, y)
+
+        Returns a tuple of (filename, x value, y value, values), where values
+        is a dict keyed by (field, statistic), or (filename, message) if the
+        file cannot be summarized.
+    '''
+    filename, fields, statistics, x, y = job
+    e = fileio.Experiment(filename, lazy=True)
+    for var in (x, y):
+        if str(getattr(e, var, None)) == 'None':
+            return filename, '"{}" is not a metadata header.'.format(var)
+    missing = [field for field in fields if field not in e.fields]
+    if len(missing) > 0:
+        return filename, '{} not a header.'.format(missing)
+    values = {}
+    for field, X in zip(fields, e.sorted_endpoints(fields)):
+        for name in statistics:
+            values[(field, name)] = statistic(X, name)
+    return filename, getattr(e, x), getattr(e, y), values
+
+
+def _sort_key(value):
+    '''
+        Internal function which sorts metadata values numerically if they
+        are numbers.
+    '''
+    try:
+        return (0, float(value), '')
+    except ValueError:
+        return (1, 0., value)
+
 
 #
 #   MAIN ROUTINE
@@ -26,10 +101,20 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('filenames', nargs='+',
-                        help = 'filenames for data files.')
+                        help = 'filenames for data files, or folders of ' \
+                               'data files.')
     parser.add_argument('-f', '--field', action='store',
-                        default = 'a',
-                        help = 'the field to compare across simulations.')
+                        nargs = '+',
+                        default = ['a'],
+                        help = 'the field(s) to compare across simulations, ' \
+                               'e.g. a aa F homogamy.')
+    parser.add_argument('-s', '--statistic', action='store',
+                        nargs = '+',
+                        type = _statistic_name,
+                        default = ['median'],
+                        help = 'the statistic(s) to tabulate: median, mean, ' \
+                               'std, or qP for the Pth percentile, e.g. q2.5. ' \
+                               '(default median).')
     parser.add_argument('-x', action='store',
                         default = 'aa_fitness',
                         help = 'the x variable to compare across simulations.')
@@ -41,51 +126,58 @@ if __name__ == '__main__':
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    experiments = []
+    filenames = []
     for filename in args.filenames:
-        # Check to see if each individual file exists
-        if os.path.isfile(filename):
-            experiments.append(fileio.Experiment(filename))
-            print 'Reading {}'.format(filename)
+        if os.path.isdir(filename):
+            # a folder holds a whole sweep
+            filenames += sorted(glob.glob(os.path.join(filename, '*.tsv')) +
+                                glob.glob(os.path.join(filename, '*' + fileio.BINARY_EXT)))
+        elif os.path.isfile(filename):
+            filenames.append(filename)
         else:
-            print "File {} not found.".format(filename)
+            print('File {} not found.'.format(filename))
             exit()
+    if len(filenames) == 0:
+        print('No data files found.')
+        exit()
 
-    # Check to see if the field is a valid one
-    for e in experiments:
-        if not hasattr(e, args.x):
-            print '"{}" is not a metadata header in {}.'\
-                  ''.format(args.x, e.filename)
-            exit()
-        if not hasattr(e, args.y):
-            print '"{}" is not a metadata header in {}.'\
-                  ''.format(args.y, e.filename)
-            exit()
-
-    l = []
-    for e in experiments:
-        l += [(getattr(e, args.y), getattr(e, args.x),
-              numpy.median(e.select(args.field)[-1]))]
-    table = sorted(l)
-
-    # now print the damn table
-    print
-    print '** Medians for "{}" as a function of "{}" and "{}" **'.format(args.field, args.x, args.y)
-    # print X headers
-    #print '{:30}   '
-    #for t in table:
-    #    print '{:^8}   '.format(t[0]),
-    #print
-
-    y0 = None
-    for (y, x, M) in table:
-        if y == y0:
-            print '{:0.6f}  '.format(M),
-        else:
-            y0 = y
-            print
-            print '{:^6}  '.format(y),
+    # every file is read once, in parallel, for all fields and statistics
+    print('Reading {} file(s)...'.format(len(filenames)))
+    pool = multiprocessing.Pool()
+    jobs = [(filename, args.field, args.statistic, args.x, args.y)
+            for filename in filenames]
+    table = {}
+    for result in pool.imap(_summarize, jobs):
+        if len(result) == 2:
+            print('   {}: {}'.format(*result))
             continue
-    print
-    print 'Done.'
-    exit()
+        filename, x, y, values = result
+        if (x, y) in table:
+            print('   {}: {} and {} are already in the table; skipped.' \
+                  ''.format(filename, x, y))
+            continue
+        table[(x, y)] = values
+        print('   {}'.format(filename))
+    pool.close()
+    if len(table) == 0:
+        exit()
+
+    xs = sorted(set(x for x, y in table), key=_sort_key)
+    ys = sorted(set(y for x, y in table), key=_sort_key)
+    for field in args.field:
+        for name in args.statistic:
+            print()
+            print('** {} of "{}" as a function of "{}" and "{}" **' \
+                  ''.format(name, field, args.x, args.y))
+            print('{:>10}  '.format(args.y) +
+                  ''.join('{:^10}  '.format(x) for x in xs) + args.x)
+            for y in ys:
+                row = '{:>10}  '.format(y)
+                for x in xs:
+                    if (x, y) in table:
+                        row += '{:0.6f}    '.format(table[(x, y)][(field, name)])
+                    else:
+                        row += '{:^10}  '.format('-')
+                print(row)
+    print()
+    print('Done.')
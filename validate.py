@@ -0,0 +1,250 @@
+#!/usr/local/bin/python3 -u
+# -*- coding: utf-8 -*-
+# We generally follow PEP 8: http://legacy.python.org/dev/peps/pep-0008/
+
+'''
+*Derek C. Braun, Brian H. Greenwald, Samir Jain, Eric Epstein, Brienna Herold, Maggie Gray
+(*derek.braun@gallaudet.edu)
+
+Checks that faster simulation engines are statistically equivalent to the
+reference engine (simuAssortativeMatingWithFitness with customChooser).
+Both are run on small populations over a grid of homogamy and fitness
+values, and the per-generation distributions of each field are compared
+with two-sample Kolmogorov-Smirnov tests and a bound on the difference in
+means. With fitness 1.0, the mean aa of every engine is also compared with
+the Crow & Felsenstein (1968) recursion in my_math.py. The speedup of each
+engine over the reference is reported with its verdict.
+
+The default allele frequency is much higher than in the publication's
+simulations, so that fitness and homogamy change the results enough for
+a wrong engine to be caught. As a self-check, the reference engine is
+also run with PLANTED errors in its parameters, which must be flagged.
+
+Exits with status 1 if any engine fails, or a planted error is missed, so
+it can be run on every change.
+'''
+
+import sys
+import time
+import argparse
+import itertools
+import numpy
+from scipy import stats
+import fileio
+import my_math
+import simulator
+
+FIELDS = ['a', 'aa', 'homogamy', 'F']
+# errors planted in the reference run's parameters by the self-check
+PLANTED = {'aa_fitness': 0.25, 'aa_homogamy': 0.1}
+
+
+def run(e, replicates, batch=None):
+    '''
+        Runs replicates of an experiment with the engine in e.engine.
+
+        Accepts:
+        e               an Experiment object
+        replicates      the number of simulations
+        batch           with the aggregate engine, run all replicates as
+                        one batch
+
+        Returns the data, as a float array of shape (replicates,
+        generations, fields), and the time taken in seconds.
+    '''
+    start = time.time()
+    if batch:
+        data = simulator.batchAssortativeMatingWithFitness(e, replicates,
+                            simulator.replicate_seed(e.seed, 0, replicates,
+                                            simulator.configuration_key(e)))
+    else:
+        simulation = simulator.Simulation(e) if e.engine != 'aggregate' else None
+        data = numpy.array([simulator.simulate(e, replicate, simulation)['data']
+                            for replicate in range(replicates)], dtype=float)
+    return data, time.time() - start
+
+
+def compare(reference, candidate, alpha=0.01, sigma=4., atol=1e-4):
+    '''
+        Compares the per-generation distributions of FIELDS in two runs.
+
+        Accepts:
+        reference       data from run, shape (replicates, generations, fields)
+        candidate       data from run
+        alpha           the significance level, after a Bonferroni
+                        correction over every field and generation
+        sigma           the largest difference in means allowed, in
+                        standard errors of the difference
+        atol            an absolute difference in means that is always
+                        allowed, for fields that hardly vary
+
+        Returns a dict with the smallest corrected KS p-value, the largest
+        difference in means in standard errors, and whether both pass.
+    '''
+    p_values = []
+    z_scores = []
+    for field in FIELDS:
+        i = simulator.FIELDS.index(field)
+        for g in range(reference.shape[1]):
+            X = reference[:,g,i]
+            Y = candidate[:,g,i]
+            if numpy.ptp(X) == 0 and numpy.ptp(Y) == 0:
+                p_values.append(1. if X[0] == Y[0] else 0.)
+            else:
+                p_values.append(stats.ks_2samp(X, Y, method='asymp').pvalue)
+            difference = abs(X.mean() - Y.mean())
+            se = numpy.sqrt(X.var(ddof=1)/len(X) + Y.var(ddof=1)/len(Y))
+            z_scores.append(0. if difference <= atol else
+                            (numpy.inf if se == 0 else difference/se))
+    p = min(1., min(p_values)*len(p_values))
+    z = max(z_scores)
+    return {'p': p, 'z': z, 'pass': p >= alpha and z <= sigma}
+
+
+def expected_z(e, data):
+    '''
+        Returns the largest difference, in standard errors, between the
+        mean aa of each generation and the Crow & Felsenstein (1968)
+        expectation. The recursion has no selection, so this is only
+        meaningful with fitness 1.0.
+    '''
+    r, aa = my_math.crowFelsenstein(e.aa_homogamy, e.a, e.deaf,
+                                    data.shape[1])
+    X = data[:,:,simulator.FIELDS.index('aa')]
+    se = X.std(axis=0, ddof=1)/numpy.sqrt(len(X))
+    # the standard error is floored at one individual in the population
+    se = numpy.maximum(se, 1./(e.constant_pop_size*1000))
+    return float(numpy.max(numpy.abs(X.mean(axis=0) - aa)/se))
+
+
+def planted(value, error):
+    '''
+        Returns a parameter value with an error planted in it: value - error,
+        or value + error if that would be negative.
+    '''
+    return value - error if value - error >= 0 else value + error
+
+
+#
+#   MAIN ROUTINE
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--pop_size',
+                        action = 'store',
+                        type = float,
+                        default = 1.,
+                        help = 'constant population size, in thousands ' \
+                               '(default 1).')
+    parser.add_argument('-a',
+                        action = 'store',
+                        type = float,
+                        default = 0.1,
+                        help = 'the starting frequency of the a allele; the ' \
+                               'frequency of deafness from other causes is ' \
+                               'kept as in simulator.py (default 0.1).')
+    parser.add_argument('--homogamy',
+                        action = 'store',
+                        nargs = '+',
+                        type = float,
+                        default = [0.0, 0.9],
+                        help = 'the homogamy values of the grid ' \
+                               '(default 0.0 0.9).')
+    parser.add_argument('-f', '--fitness',
+                        action = 'store',
+                        nargs = '+',
+                        type = float,
+                        default = [0.5, 1.0],
+                        help = 'the fitness values of the grid ' \
+                               '(default 0.5 1.0).')
+    parser.add_argument('-n', '--replicates',
+                        action = 'store',
+                        type = int,
+                        default = 200,
+                        help = 'simulations per engine and grid point ' \
+                               '(default 200).')
+    parser.add_argument('--reference',
+                        action = 'store',
+                        choices = ['python', 'numpy', 'aggregate'],
+                        default = 'python',
+                        help = 'the reference engine (default python).')
+    parser.add_argument('-e', '--engines',
+                        action = 'store',
+                        nargs = '+',
+                        choices = ['python', 'numpy', 'aggregate', 'batch'],
+                        default = ['numpy', 'aggregate', 'batch'],
+                        help = 'the engines to check; batch is the aggregate ' \
+                               'engine run with --batch (default numpy ' \
+                               'aggregate batch).')
+    parser.add_argument('--alpha',
+                        action = 'store',
+                        type = float,
+                        default = 0.01,
+                        help = 'the significance level of the KS tests, ' \
+                               'Bonferroni corrected (default 0.01).')
+    parser.add_argument('--sigma',
+                        action = 'store',
+                        type = float,
+                        default = 4.,
+                        help = 'the largest difference in means allowed, in ' \
+                               'standard errors (default 4).')
+    parser.add_argument('-s', '--seed',
+                        action = 'store',
+                        type = int,
+                        default = 1,
+                        help = 'master seed; each engine gets its own seed ' \
+                               'derived from it (default 1).')
+    args=parser.parse_args()
+
+    deaf = args.a**2 + simulator.DEAF_FREQ - simulator.a_FREQ**2
+    row = '{:>8}  {:>7}  {:>16}  {:>8}  {:>8}  {:>7}  {:>8}  {:>7}'
+    print(row.format('homogamy', 'fitness', 'engine', 'speedup', 'KS p',
+                     'max z', 'C&F z', 'verdict'))
+    failed = False
+    for homogamy, fitness in itertools.product(args.homogamy, args.fitness):
+        runs = [(engine, {}) for engine in [args.reference] + args.engines]
+        runs += [(args.reference, {param: planted(value, PLANTED[param])})
+                 for param, value in [('aa_fitness', fitness),
+                                      ('aa_homogamy', homogamy)]]
+        for k, (engine, errors) in enumerate(runs):
+            seed = int(numpy.random.SeedSequence([args.seed, k]).generate_state(1)[0])
+            e = fileio.Experiment(constant_pop_size   = args.pop_size,
+                                  a                   = args.a,
+                                  aa_fitness          = fitness,
+                                  aa_homogamy         = homogamy,
+                                  deaf                = deaf,
+                                  generations         = simulator.GENERATIONS,
+                                  engine              = 'aggregate' if engine == 'batch' else engine,
+                                  seed                = seed)
+            for param, value in errors.items():
+                setattr(e, param, value)
+            data, seconds = run(e, args.replicates, batch=(engine == 'batch'))
+            # the recursion has no selection, so it is only checked at 1.0
+            cf = expected_z(e, data) if e.aa_fitness == 1.0 else None
+            cf_pass = cf is None or cf <= args.sigma
+            cf = '{:8.2f}'.format(cf) if cf is not None else '-'
+            if k == 0:
+                reference, reference_seconds = data, seconds
+                failed = failed or not cf_pass
+                print(row.format(homogamy, fitness, '{} (ref)'.format(engine),
+                                 '1.0x', '-', '-', cf,
+                                 'pass' if cf_pass else 'FAIL'))
+                continue
+            result = compare(reference, data, args.alpha, args.sigma)
+            if len(errors) > 0:
+                # a planted error must be caught by the comparison
+                label = '{}={:g}'.format(*list(errors.items())[0])
+                verdict = 'caught' if not result['pass'] else 'MISSED'
+                failed = failed or result['pass']
+            else:
+                label = engine
+                passed = result['pass'] and cf_pass
+                verdict = 'pass' if passed else 'FAIL'
+                failed = failed or not passed
+            print(row.format(homogamy, fitness, label,
+                             '{:.1f}x'.format(reference_seconds/max(seconds, 1e-9)),
+                             '{:.3g}'.format(result['p']),
+                             '{:.2f}'.format(result['z']), cf, verdict))
+    print('Done.')
+    sys.exit(1 if failed else 0)